@@ -38,15 +38,31 @@ from cs530.utils.vtk_helper import (
     connect,
     correct_reader,
     correct_writer,
+    set_precision,
+    get_precision,
 )
 from cs530.utils.vtk_interpolation import (
     Interpolator,
     TimeInterpolator,
+    WindowScheduler,
 )
 from cs530.utils.vtk_io import (
     read_vtk_file,
     save_vtk_file,
 )
+from cs530.utils.vtk_bricks import (
+    BrickedVolume,
+    BrickedInterpolator,
+)
+from cs530.utils.vtk_timeseries import (
+    pack_time_series,
+    TimeSeriesStore,
+    SharedTimeSeries,
+    SharedFields,
+)
+from cs530.utils.vtk_profiling import (
+    Profiler,
+)
 from cs530.utils.vtk_qt import (
     slider_setup,
     QtVTKProgram,
@@ -61,12 +77,36 @@ from cs530.utils.vtk_rendering import (
     make_fiber_actor,
     take_screenshot,
 )
+from cs530.tools.ensemble import (
+    integrate_ensemble,
+    EnsembleResult,
+)
+from cs530.tools.kernels import (
+    sample_uniform,
+    advect_particles,
+)
+from cs530.tools.curves import (
+    CurveSet,
+)
+from cs530.tools.pathline_store import (
+    PathlineWriter,
+    PathlineStore,
+)
+from cs530.tools.flowmap import (
+    FlowMap,
+)
 from cs530.tools.pathlines import (
     trace_pathlines,
+    trace_streaklines,
+    trace_timelines,
+)
+from cs530.tools.ftle import (
+    ftle,
 )
 from cs530.tools.TensorLines import (
     TensorLines,
     RHS,
+    EigenVolume,
 )
 from cs530.tools.SuperquadricTensorGlyph import (
     SuperquadricTensorGlyph,
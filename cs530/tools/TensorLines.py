@@ -7,69 +7,102 @@ import math
 import time
 from tqdm import tqdm
 
+from cs530.utils.vtk_interpolation import Interpolator as _Interpolator
+from cs530.utils.vtk_bricks import BrickedVolume, BrickedInterpolator
+from cs530.tools.curves import CurveSet
+
 __all__ = [
     'TensorLines',
-    'RHS'
+    'RHS',
+    'EigenVolume',
 ]
 
 class Interpolator:
-    def __init__(self, dataset):
+    ''' Tensor interpolation in a vtkDataSet or, for volumes that do not
+        fit in memory, in a BrickedVolume. Raises ValueError outside of
+        the domain '''
+    def __init__(self, dataset, dtype=None):
+        # dtype: storage precision of the tensor values (see Interpolator)
         self.dataset = dataset 
-        self.locator = None
-        bnds = self.dataset.GetBounds()
+        if isinstance(dataset, (BrickedVolume, str)):
+            self.interpolator = BrickedInterpolator(dataset, raise_oob_error=True)
+            bnds = self.interpolator.volume.bounds()
+        else:
+            self.interpolator = _Interpolator(dataset, dataset.GetPointData().GetTensors(), raise_oob_error=True, dtype=dtype)
+            bnds = self.dataset.GetBounds()
         self.bounds = [ np.array([bnds[0], bnds[2], bnds[4]]), 
                         np.array([bnds[1], bnds[3], bnds[5]]) ]
-        if isinstance(self.dataset, vtk.vtkImageData):
-            self.is_image = True 
-            self.dims = np.array(dataset.GetDimensions())
-            self.origin = np.array(dataset.GetOrigin())
-            self.spacing = np.array(dataset.GetSpacing())
-            self.tensors = nps.vtk_to_numpy(dataset.GetPointData().GetTensors()).reshape((self.dims[2], self.dims[1], self.dims[0], 9))
-        else:
-            self.is_image = False 
-            self.locator = vtk.vtkCellTreeLocator()
-            self.locator.SetDataSet(self.data)
-            self.locator.BuildLocator()
-
-    def interpolate_image(self, pos):
-        x = (pos-self.origin)/self.spacing
-        cellid = np.floor(x)
-        if np.any(x < 0) or np.any(cellid > self.dims-2):
-            raise RuntimeError('Invalid position')
-        u, v, w = x - cellid
-        i, j, k = cellid.astype(int)
-        T  = ((1-u)*(1-v)*(1-w))*self.tensors[  k,   j,   i, :] + \
-             (   u *(1-v)*(1-w))*self.tensors[  k,   j, 1+i, :] + \
-             (   u *   v *(1-w))*self.tensors[  k, 1+j, 1+i, :] + \
-             ((1-u)*   v *(1-w))*self.tensors[  k, 1+j,   i, :] + \
-             ((1-u)*(1-v)*   w )*self.tensors[1+k,   j,   i, :] + \
-             (   u *(1-v)*   w )*self.tensors[1+k,   j, 1+i, :] + \
-             (   u *   v *   w )*self.tensors[1+k, 1+j, 1+i, :] + \
-             ((1-u)*   v *   w )*self.tensors[1+k, 1+j,   i, :]
-        return T.reshape(3, 3)
-
-    def interpolate(self, pos):
-        cellid = self.locator.FindCell(p)
-        if cellid == -1:
-            raise ValueError('Invalid Position')
-        cell = self.data.GetCell(cellid)
-        weights = np.zeros((8), dtype=float)
-        pcoords = np.zeros((3), dtype=float)
-        closest = np.zeros((3), dtype=float)
-        subId = vtk.reference(0)
-        dist = vtk.reference(0)
-        cell.EvaluatePosition(p, closest, subId, pcoords, dist, weights)
-        T = np.zeros((9), dtype=float)
-        for i in range(cell.GetNumberOfPoints()):
-            pid = cell.GetPointId(i)
-            T += weights[i] * np.array(self.data.GetPointData().GetTensors().GetTuple9(pid))
-        return T.reshape(3,3)
 
     def __call__(self, pos):
-        if self.is_image:
-            return self.interpolate_image(pos)
+        return np.asarray(self.interpolator(0, pos)).reshape(3, 3)
+
+    @property
+    def nbytes(self):
+        return self.interpolator.nbytes
+
+
+def _eigen_fields(tensors, chunk_size=1<<18):
+    # major eigenvectors (N,3) and fractional anisotropy (N,) of (N,9)
+    # symmetric tensors, one batched decomposition per chunk
+    tensors = np.asarray(tensors).reshape(-1, 3, 3)
+    evecs = np.empty((len(tensors), 3))
+    fas = np.empty(len(tensors))
+    for start in range(0, len(tensors), chunk_size):
+        evals, vecs = np.linalg.eigh(tensors[start:start+chunk_size])
+        evecs[start:start+chunk_size] = vecs[:, :, 2]
+        l0, l1, l2 = evals[:, 0], evals[:, 1], evals[:, 2]
+        num = (l0-l1)**2 + (l1-l2)**2 + (l2-l0)**2
+        den = 2*(l0*l0 + l1*l1 + l2*l2)
+        fas[start:start+chunk_size] = np.sqrt(num/np.where(den > 0, den, 1)) * (den > 0)
+    return evecs, fas
+
+class EigenVolume:
+    ''' Major eigenvector and FA of a tensor field, computed once for all
+        points of the dataset (or read from its 'major_eigenvector' and 'FA'
+        arrays, see to_dataset). Eigenvectors are sign-aligned within each
+        cell at lookup time. Raises ValueError outside of the domain '''
+    def __init__(self, dataset, dtype=None):
+        pd = dataset.GetPointData()
+        if pd.GetArray('major_eigenvector') is not None and pd.GetArray('FA') is not None:
+            evecs = nps.vtk_to_numpy(pd.GetArray('major_eigenvector'))
+            fas = nps.vtk_to_numpy(pd.GetArray('FA'))
         else:
-            return self.interpolate(pos)
+            evecs, fas = _eigen_fields(nps.vtk_to_numpy(pd.GetTensors()))
+        self.dataset = dataset
+        self.interpolator = _Interpolator(dataset, [evecs, fas], raise_oob_error=True, dtype=dtype)
+        self.evecs, self.fas = self.interpolator.fields
+
+    def direction(self, pos, reference=None):
+        # unit major eigenvector at pos. Vertex eigenvectors are flipped to
+        # agree with reference (by default, that of the vertex of largest
+        # weight) before interpolation
+        ids, weights = self.interpolator.locate(np.asarray(pos, dtype=float))
+        e = self.evecs[ids].astype(float)
+        if reference is None:
+            reference = e[np.argmax(weights)]
+        e[e @ reference < 0] *= -1
+        v = weights @ e
+        norm = np.linalg.norm(v)
+        return v/norm if norm > 0 else v
+
+    def FA(self, pos):
+        ids, weights = self.interpolator.locate(np.asarray(pos, dtype=float))
+        return float(weights @ self.fas[ids])
+
+    def to_dataset(self):
+        # shallow copy of the dataset with 'major_eigenvector' and 'FA'
+        # arrays, e.g., to be saved and reused
+        copy = self.dataset.NewInstance()
+        copy.ShallowCopy(self.dataset)
+        for name, values in [ ('major_eigenvector', self.evecs), ('FA', self.fas) ]:
+            array = nps.numpy_to_vtk(np.ascontiguousarray(values))
+            array.SetName(name)
+            copy.GetPointData().AddArray(array)
+        return copy
+
+    @property
+    def nbytes(self):
+        return self.interpolator.nbytes
 
 
 '''
@@ -126,8 +159,14 @@ def FA(l0, l1, l2):
 Vector field interface to major eigenvector field of symmetric tensor field
 '''
 class RHS:
-    def __init__(self, data, minFA=0.3):
-        self.interpolator = Interpolator(data)
+    def __init__(self, data, minFA=0.3, dtype=None, precompute=True):
+        # precompute: look up major eigenvectors and FA in an EigenVolume
+        # instead of decomposing interpolated tensors (vtkDataSet input only).
+        # FA is then interpolated rather than computed from the tensor
+        self.interpolator = Interpolator(data, dtype)
+        self.eigen = None
+        if precompute and isinstance(data, vtk.vtkDataSet):
+            self.eigen = EigenVolume(data, dtype)
         self.data = data
         self.bounds = self.interpolator.bounds
         self.last = None
@@ -135,6 +174,8 @@ class RHS:
         self.minFA = minFA
 
     def lower_bound_FA(self, t, y):
+        if self.eigen is not None:
+            return self.eigen.FA(y) - self.minFA
         T = self.interpolator(y)
         evs = symeigendec(T, True)
         v = FA(evs[0], evs[1], evs[2])
@@ -148,6 +189,11 @@ class RHS:
         return self.interpolator(pos)
 
     def FA(self, pos):
+        if self.eigen is not None:
+            try:
+                return self.eigen.FA(pos)
+            except ValueError:
+                return 0
         try:
             T = self.value(pos)
         except Exception as e:
@@ -161,21 +207,26 @@ class RHS:
     '''
     Interpolating functor
     '''
+    def major(self, pos):
+        if self.eigen is not None:
+            return self.eigen.direction(pos, self.last)
+        evs, evecs = symeigendec(self.value(pos))
+        return evecs[:,2]
+
     def __call__(self, t, pos):
         try:
-            T = self.value(pos)
+            v = self.major(pos)
         except Exception as e:
             return np.array([0,0,0])
-        evs, evecs = symeigendec(T)
         d = 1
         if self.last is None:
-            self.last = self.sign*evecs[:,2]
+            self.last = self.sign*v
         else:
-            d = np.dot(self.last, evecs[:,2])
+            d = np.dot(self.last, v)
             if d < 0:
-                self.last = -1 * evecs[:,2]
+                self.last = -1 * v
             else:
-                self.last = evecs[:,2]
+                self.last = v
         return self.last
 
 class FAUnderflowEvent:
@@ -205,6 +256,8 @@ class TLine:
 
     def FillInputPortInformation(self, vtkself, port, info):
         info.Set(vtk.vtkAlgorithm.INPUT_REQUIRED_DATA_TYPE(), "vtkDataSet")
+        # no input needed when tensors come from a bricked volume
+        info.Set(vtk.vtkAlgorithm.INPUT_IS_OPTIONAL(), 1)
         return 1
 
     def FillOutputPortInformation(self, vtkself, port, info):
@@ -221,6 +274,9 @@ class TLine:
     def SetSource(self, source):
         self.source = source
 
+    def SetVolume(self, volume):
+        self.volume = volume
+
     def SetMinFA(self, minFA):
         self.minFA = minFA
 
@@ -233,14 +289,19 @@ class TLine:
     def SetStepSize(self, dh):
         self.stepsize = dh
 
+    def SetPrecompute(self, precompute):
+        self.precompute = precompute
+
     def __init__(self, source=None, stepsize=1, length=100, nsteps=500, 
                  minFA=0.3, control_saturation=False):
         self.source = source
+        self.volume = None
         self.stepsize = stepsize
         self.length = length 
         self.nsteps = nsteps
         self.minFA = minFA
         self.control_saturation = control_saturation
+        self.precompute = True
         self.rtol = 1.0e-3
         self.atol = 1.0e-3
 
@@ -278,13 +339,12 @@ class TLine:
         elif not isinstance(self.source, vtk.vtkDataSet):
             raise Exception('Source is not a vtkDataSet in TensorLine')
         
-        self.rhs = RHS(self.input, minFA=self.minFA)
+        self.rhs = RHS(self.volume if self.volume is not None else self.input, minFA=self.minFA,
+                       precompute=self.precompute)
         self.fa_event = FAUnderflowEvent(self.rhs, self.minFA)
         self.out_event = OutOfDomainEvent(self.rhs)
         pts = self.source.GetPoints()
-        all_lines = vtk.vtkCellArray()
-        all_coords = []
-        all_colors = []
+        curves = CurveSet()
         t_integrate = 0
         t_color = 0
         n_integrate = 0
@@ -302,19 +362,11 @@ class TLine:
                     n_color += 1
 
                 if points is not None and points.shape[0] > 50:
-                    n = points.shape[0]
-                    k = len(all_coords)
-                    all_coords.extend(points.tolist())
-                    all_lines.InsertNextCell(n, np.arange(k, k+n))
-                    all_colors.extend(colors.tolist())
+                    curves.add_curve(points, colors=colors)
         t1 = time.process_time()
-        print(f'{all_lines.GetNumberOfCells()} fibers integrated in {t1-t0} seconds ({float(all_lines.GetNumberOfCells())/(t1-t0)} Hz.)')
+        print(f'{len(curves)} fibers integrated in {t1-t0} seconds ({float(len(curves))/(t1-t0)} Hz.)')
         print(f'integration time: {t_integrate} s. ({t_integrate/(t1-t0)*100}% / {float(n_integrate)/t_integrate} Hz.), coloring time: {t_color} s. ({t_color/(t1-t0)*100}% / {float(n_color)/t_color} Hz.)')
-        vtkpts = vtk.vtkPoints()
-        vtkpts.SetData(nps.numpy_to_vtk(np.array(all_coords)))
-        self.output.SetPoints(vtkpts)
-        self.output.SetLines(all_lines)
-        self.output.GetPointData().SetScalars(nps.numpy_to_vtk(np.array(all_colors, dtype=np.uint8)))
+        curves.to_polydata(self.output, scalars='colors')
 
 class TensorLines(vtk.vtkPythonAlgorithm):
     def __init__(self):
@@ -326,6 +378,11 @@ class TensorLines(vtk.vtkPythonAlgorithm):
         self.tline.SetSource(source) 
         self.Modified()
 
+    def SetVolume(self, volume):
+        # BrickedVolume (or its path) used instead of the input tensor field
+        self.tline.SetVolume(volume)
+        self.Modified()
+
     def SetIntegrationLength(self, length):
         self.tline.SetLength(length)
         self.Modified()
@@ -337,6 +394,12 @@ class TensorLines(vtk.vtkPythonAlgorithm):
     def SetMinFA(self, minfa):
         self.tline.SetMinFA(minfa)
 
+    def SetPrecompute(self, precompute):
+        # eigenvectors and FA computed once for all voxels (default) or
+        # per evaluation from interpolated tensors
+        self.tline.SetPrecompute(precompute)
+        self.Modified()
+
     def SetMaxNumberOfSteps(self, nsteps):
         self.tline.SetMaxNumberOfSteps(nsteps)
 
@@ -0,0 +1,167 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support as nps
+
+'''
+Compact storage of a set of integral curves: the points of all curves are
+kept in one growable array, per-point attributes (time, colour, ...) in
+arrays of the same length, and curve boundaries in an int64 offsets array.
+Conversion to vtkPolyData wraps these arrays without per-point work.
+'''
+
+__all__ = [
+    'CurveSet',
+]
+
+class _GrowableArray:
+    # contiguous (n, ...) array with amortized O(1) append
+    def __init__(self, shape, dtype, capacity=1024):
+        self.buffer = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self.size = 0
+
+    @classmethod
+    def wrap(cls, values):
+        # growable array using values as its initial buffer (no copy)
+        array = cls.__new__(cls)
+        array.buffer = np.ascontiguousarray(values)
+        array.size = len(values)
+        return array
+
+    def reserve(self, capacity):
+        if capacity > self.buffer.shape[0]:
+            capacity = max(capacity, 2*self.buffer.shape[0])
+            buffer = np.empty((capacity,) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+
+    def extend(self, values):
+        n = len(values)
+        self.reserve(self.size + n)
+        self.buffer[self.size:self.size+n] = values
+        self.size += n
+
+    @property
+    def array(self):
+        return self.buffer[:self.size]
+
+class CurveSet:
+    def __init__(self, dim=3, dtype=float, capacity=1024):
+        self.dim = dim
+        self.capacity = capacity
+        self._points = _GrowableArray((dim,), dtype, capacity)
+        self._offsets = _GrowableArray((), np.int64, 64)
+        self._offsets.extend([0])
+        self._attributes = {}
+
+    @classmethod
+    def from_arrays(cls, points, offsets, **attributes):
+        # curve set wrapping points (N, dim), offsets (ncurves+1,) and
+        # per-point attributes without copying them
+        points = np.asarray(points)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets[0] != 0 or offsets[-1] != len(points):
+            raise ValueError(f'Offsets do not match {len(points)} points')
+        curves = cls(points.shape[1], points.dtype)
+        curves._points = _GrowableArray.wrap(points)
+        curves._offsets = _GrowableArray.wrap(offsets)
+        for name, values in attributes.items():
+            if len(values) != len(points):
+                raise ValueError(f'Attribute {name} has {len(values)} values for {len(points)} points')
+            curves._attributes[name] = _GrowableArray.wrap(np.asarray(values))
+        return curves
+
+    def __len__(self):
+        return self._offsets.size - 1
+
+    @property
+    def npoints(self):
+        return self._points.size
+
+    @property
+    def points(self):
+        return self._points.array
+
+    @property
+    def offsets(self):
+        return self._offsets.array
+
+    @property
+    def nbytes(self):
+        return self.points.nbytes + self.offsets.nbytes + \
+               sum(a.array.nbytes for a in self._attributes.values())
+
+    def attribute(self, name):
+        return self._attributes[name].array
+
+    def attribute_names(self):
+        return list(self._attributes.keys())
+
+    def _extend_attributes(self, n, attributes):
+        if len(self) > 0 and set(attributes.keys()) != set(self._attributes.keys()):
+            raise ValueError(f'Attributes {list(attributes.keys())} do not match {self.attribute_names()}')
+        for name, values in attributes.items():
+            values = np.asarray(values)
+            if len(values) != n:
+                raise ValueError(f'Attribute {name} has {len(values)} values for {n} points')
+            if name not in self._attributes:
+                self._attributes[name] = _GrowableArray(values.shape[1:], values.dtype, self.capacity)
+            self._attributes[name].extend(values)
+
+    def add_curve(self, points, **attributes):
+        # append one curve with optional per-point attributes, returns its index
+        points = np.asarray(points).reshape(-1, self.dim)
+        self._extend_attributes(len(points), attributes)
+        self._points.extend(points)
+        self._offsets.extend([self._points.size])
+        return len(self) - 1
+
+    def add_curves(self, points, counts, **attributes):
+        # append several curves stored back to back, with counts[i] points each
+        points = np.asarray(points).reshape(-1, self.dim)
+        counts = np.asarray(counts, dtype=np.int64)
+        if np.sum(counts) != len(points):
+            raise ValueError(f'{len(points)} points do not match curve sizes (total {np.sum(counts)})')
+        self._extend_attributes(len(points), attributes)
+        base = self._points.size
+        self._points.extend(points)
+        self._offsets.extend(base + np.cumsum(counts))
+
+    def curve(self, i):
+        start, stop = self.offsets[i], self.offsets[i+1]
+        return self.points[start:stop]
+
+    def curve_attribute(self, name, i):
+        start, stop = self.offsets[i], self.offsets[i+1]
+        return self.attribute(name)[start:stop]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def line_ids(self):
+        # list of point id lists (as expected by add_polylines)
+        offsets = self.offsets
+        return [ list(range(offsets[i], offsets[i+1])) for i in range(len(self)) ]
+
+    def to_polydata(self, polydata=None, scalars=None):
+        # vtkPolyData with one polyline per curve and attributes as point data.
+        # scalars: name of the attribute set as active scalars
+        if polydata is None:
+            polydata = vtk.vtkPolyData()
+        points = self.points
+        if self.dim != 3:
+            points = np.column_stack([points, np.zeros((len(points), 3-self.dim))])
+        vtkpts = vtk.vtkPoints()
+        vtkpts.SetData(nps.numpy_to_vtk(points))
+        lines = vtk.vtkCellArray()
+        lines.SetData(nps.numpy_to_vtk(self.offsets, array_type=vtk.VTK_ID_TYPE),
+                      nps.numpy_to_vtk(np.arange(self.npoints, dtype=np.int64), array_type=vtk.VTK_ID_TYPE))
+        polydata.SetPoints(vtkpts)
+        polydata.SetLines(lines)
+        for name, values in self._attributes.items():
+            array = nps.numpy_to_vtk(values.array)
+            array.SetName(name)
+            if name == scalars:
+                polydata.GetPointData().SetScalars(array)
+            else:
+                polydata.GetPointData().AddArray(array)
+        return polydata
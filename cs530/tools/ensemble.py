@@ -0,0 +1,257 @@
+import numpy as np
+from scipy.integrate import RK45, DOP853
+
+'''
+Integration of large ensembles of particles with a batched embedded
+Runge-Kutta scheme. All live particles are advanced together: every stage
+is a single batched evaluation of the right-hand side, while step size,
+error control and termination are handled per particle with masks.
+'''
+
+__all__ = [
+    'integrate_ensemble',
+    'EnsembleResult',
+]
+
+# step size control constants (same as scipy.integrate)
+_SAFETY = 0.9
+_MIN_FACTOR = 0.2
+_MAX_FACTOR = 10
+
+# particle status
+SUCCESS = 0
+LEFT_DOMAIN = 1
+FAILED = -1
+
+_METHODS = { 'RK45': RK45, 'DOP853': DOP853 }
+
+class EnsembleResult:
+    ''' t, y: final time and position of each particle.
+        status: SUCCESS (0) if t_span[1] was reached, LEFT_DOMAIN (1) if the
+        particle stopped at the boundary of the domain, FAILED (-1) if the
+        step size underflowed.
+        t_eval, y_eval: (M,) sampling times and (M, N, d) positions, NaN
+        where a particle was not alive.
+        steps: with record_steps, (particle, time, position) of every
+        accepted step, ordered by particle, else None.
+        naccepted, nrejected: accepted and rejected particle steps '''
+    def __init__(self, t, y, status, t_eval, y_eval, nfev, nsteps, steps=None, naccepted=0, nrejected=0):
+        self.t = t
+        self.y = y
+        self.status = status
+        self.t_eval = t_eval
+        self.y_eval = y_eval
+        self.nfev = nfev
+        self.nsteps = nsteps
+        self.steps = steps
+        self.naccepted = naccepted
+        self.nrejected = nrejected
+
+class _Tableau:
+    def __init__(self, method):
+        if method not in _METHODS:
+            raise ValueError(f'Unsupported method {method} (available: {list(_METHODS.keys())})')
+        solver = _METHODS[method]
+        self.method = method
+        self.A = solver.A
+        self.B = solver.B
+        self.C = solver.C
+        self.n_stages = solver.n_stages
+        self.exponent = -1 / (solver.error_estimator_order + 1)
+        if method == 'DOP853':
+            self.E3 = solver.E3
+            self.E5 = solver.E5
+            self.A_EXTRA = solver.A_EXTRA
+            self.C_EXTRA = solver.C_EXTRA
+            self.D = solver.D
+        else:
+            self.E = solver.E
+            self.P = solver.P
+
+    def error_norm(self, K, h, scale):
+        # per-particle RMS norm of the local error estimate
+        n = K.shape[-1]
+        if self.method == 'DOP853':
+            err5 = np.einsum('nsd,s->nd', K, self.E5) / scale
+            err3 = np.einsum('nsd,s->nd', K, self.E3) / scale
+            err5 = np.sum(err5**2, axis=-1)
+            err3 = np.sum(err3**2, axis=-1)
+            denom = err5 + 0.01*err3
+            norm = np.zeros_like(denom)
+            nz = denom > 0
+            norm[nz] = np.abs(h[nz])*err5[nz] / np.sqrt(denom[nz]*n)
+            return norm
+        err = np.einsum('nsd,s->nd', K, self.E) * h[:, None] / scale
+        return np.sqrt(np.mean(err**2, axis=-1))
+
+    def interpolant(self, fun, K, t, y_old, y_new, h):
+        # coefficients of the dense output of accepted steps and number 
+        # of additional function evaluations
+        if self.method == 'RK45':
+            return h[:, None, None] * np.einsum('nsd,sk->nkd', K, self.P), 0
+        # DOP853: three extra stages, as in scipy's dense output
+        n, nstages, dim = K.shape
+        K = np.concatenate([K, np.empty((n, len(self.C_EXTRA), dim))], axis=1)
+        for s, (a, c) in enumerate(zip(self.A_EXTRA, self.C_EXTRA), start=nstages):
+            dy = np.einsum('nsd,s->nd', K[:, :s], a[:s]) * h[:, None]
+            K[:, s], _ = fun(t + c*h, y_old + dy)
+        F = np.empty((n, 3 + self.D.shape[0], dim))
+        delta_y = y_new - y_old
+        F[:, 0] = delta_y
+        F[:, 1] = h[:, None]*K[:, 0] - delta_y
+        F[:, 2] = 2*delta_y - h[:, None]*(K[:, nstages-1] + K[:, 0])
+        F[:, 3:] = h[:, None, None] * np.einsum('ks,nsd->nkd', self.D, K)
+        return F, n*len(self.C_EXTRA)
+
+    def evaluate(self, F, y_old, theta):
+        # position at t_old + theta*h within an accepted step
+        theta = theta[:, None]
+        if self.method == 'RK45':
+            powers = theta ** np.arange(1, F.shape[1]+1)
+            return y_old + np.einsum('nkd,nk->nd', F, powers)
+        y = np.zeros_like(y_old)
+        for i, f in enumerate(F[:, ::-1].transpose(1, 0, 2)):
+            y += f
+            y *= theta if i % 2 == 0 else 1 - theta
+        return y + y_old
+
+def integrate_ensemble(fun, t_span, y0, method='RK45', t_eval=None, rtol=1.0e-3, atol=1.0e-6,
+                       first_step=None, max_step=np.inf, min_step=None, max_iterations=1000000,
+                       record_steps=False, hints=None):
+    ''' Integrate dy/dt = fun(t, y) for an (N, d) array of initial
+        conditions y0 over t_span. fun receives an (n,) array of times and
+        an (n, d) array of positions and returns an (n, d) array of
+        derivatives and an (n,) mask of positions outside of the domain
+        (e.g., TimeInterpolator.interpolate_many). A particle whose step
+        leaves the domain has its step halved until it is smaller than
+        min_step, at which point it stops at its last position. 
+        With record_steps, the end points of all accepted steps are kept. 
+        hints: optional (N,) array of per-particle cell ids (-1 if unknown,
+        see InterpolatorBase.cell_hints), updated in place. fun is then
+        called as fun(t, y, hints) with the hints of the evaluated rows, 
+        so that each particle is located from the cell it was last in. '''
+    tableau = _Tableau(method)
+    def evaluate(rows, t, y):
+        if hints is None:
+            return fun(t, y)
+        cells = hints[rows]
+        values, oob = fun(t, y, cells)
+        hints[rows] = cells
+        return values, oob
+    t0, t1 = float(t_span[0]), float(t_span[1])
+    direction = 1.0 if t1 >= t0 else -1.0
+    span = abs(t1 - t0)
+    y0 = np.atleast_2d(np.asarray(y0, dtype=float))
+    n, dim = y0.shape
+    if min_step is None:
+        min_step = 1.0e-10 * max(span, 1.0)
+    if first_step is None:
+        first_step = span / 100
+    first_step = min(abs(first_step), max_step, span) if span > 0 else 0.
+
+    if t_eval is None:
+        t_eval = np.array([], dtype=float)
+    t_eval = np.asarray(t_eval, dtype=float)
+    y_eval = np.full((len(t_eval), n, dim), np.nan)
+    # sampling times in increasing order of direction*t
+    s_eval = direction * t_eval
+
+    t = np.full(n, t0)
+    y = y0.copy()
+    h = np.full(n, first_step)
+    status = np.full(n, SUCCESS)
+    f, oob = evaluate(slice(None), t, y)
+    f = np.array(f, dtype=float).reshape(n, dim)
+    nfev = n
+    # particles seeded outside of the domain never move
+    status[oob] = LEFT_DOMAIN
+    alive = ~oob & (span > 0)
+    rejected = np.zeros(n, dtype=bool)
+    y_eval[t_eval == t0] = np.where(oob[:, None], np.nan, y0)
+    nsteps = 0
+    naccepted = 0
+    nrejected = 0
+    recorded = []
+
+    while np.any(alive) and nsteps < max_iterations:
+        nsteps += 1
+        a = np.flatnonzero(alive)
+        ta = t[a]
+        ya = y[a]
+        # do not step beyond the end of the time interval
+        ha = direction * np.minimum(h[a], np.abs(t1 - ta))
+        K = np.empty((len(a), tableau.n_stages+1, dim))
+        K[:, 0] = f[a]
+        bad = np.zeros(len(a), dtype=bool)
+        for s in range(1, tableau.n_stages):
+            dy = np.einsum('nsd,s->nd', K[:, :s], tableau.A[s, :s]) * ha[:, None]
+            ys = ya + dy
+            # stages that left the domain are evaluated at a valid position
+            ys[bad] = ya[bad]
+            K[:, s], oob_s = evaluate(a, ta + tableau.C[s]*ha, ys)
+            bad |= oob_s
+        y_new = ya + np.einsum('nsd,s->nd', K[:, :-1], tableau.B) * ha[:, None]
+        y_new[bad] = ya[bad]
+        K[:, -1], oob_s = evaluate(a, ta + ha, y_new)
+        bad |= oob_s
+        nfev += tableau.n_stages * len(a)
+        K[bad] = 0
+
+        scale = atol + np.maximum(np.abs(ya), np.abs(y_new)) * rtol
+        norm = tableau.error_norm(K, ha, scale)
+        accept = ~bad & (norm < 1)
+        naccepted += int(np.count_nonzero(accept))
+        nrejected += len(a) - int(np.count_nonzero(accept))
+
+        # step size update
+        with np.errstate(divide='ignore'):
+            factor = np.where(norm == 0, _MAX_FACTOR, _SAFETY * norm**tableau.exponent)
+        factor = np.where(accept, np.minimum(_MAX_FACTOR, factor), np.maximum(_MIN_FACTOR, factor))
+        factor[accept & rejected[a]] = np.minimum(factor[accept & rejected[a]], 1)
+        factor[bad] = 0.5
+        h_new = np.minimum(np.abs(ha) * factor, max_step)
+        h[a] = np.where(accept, h_new, np.minimum(h[a], h_new))
+        rejected[a] = ~accept
+
+        # samples within accepted steps
+        acc = np.flatnonzero(accept)
+        if len(acc) and len(t_eval):
+            lo = np.searchsorted(s_eval, direction*ta[acc], side='right')
+            hi = np.searchsorted(s_eval, direction*(ta[acc] + ha[acc]), side='right')
+            sampled = hi > lo
+            acc, lo, hi = acc[sampled], lo[sampled], hi[sampled]
+            if len(acc):
+                F, extra = tableau.interpolant(lambda ts, ys: evaluate(a[acc], ts, ys), K[acc], ta[acc], ya[acc], y_new[acc], ha[acc])
+                nfev += extra
+                for k in range(int(np.max(hi - lo))):
+                    sel = np.flatnonzero(lo + k < hi)
+                    ids = lo[sel] + k
+                    rows = acc[sel]
+                    theta = (t_eval[ids] - ta[rows]) / ha[rows]
+                    y_eval[ids, a[rows]] = tableau.evaluate(F[sel], ya[rows], theta)
+
+        done = a[accept]
+        t[done] = ta[accept] + ha[accept]
+        y[done] = y_new[accept]
+        if record_steps:
+            recorded.append((done, t[done], y_new[accept]))
+        f[done] = K[accept, -1]
+        finished = accept & (np.abs(t1 - t[a]) <= 1.0e-12 * max(span, 1.0))
+        t[a[finished]] = t1
+        alive[a[finished]] = False
+
+        # termination of particles whose step underflowed
+        underflow = ~accept & (h[a] < min_step)
+        status[a[underflow & bad]] = LEFT_DOMAIN
+        status[a[underflow & ~bad]] = FAILED
+        alive[a[underflow]] = False
+
+    status[alive] = FAILED
+    steps = None
+    if record_steps:
+        ids = np.concatenate([ r[0] for r in recorded ] + [ np.empty(0, dtype=np.int64) ])
+        order = np.argsort(ids, kind='stable')
+        steps = (ids[order], 
+                 np.concatenate([ r[1] for r in recorded ] + [ np.empty(0) ])[order],
+                 np.concatenate([ r[2] for r in recorded ] + [ np.empty((0, dim)) ])[order])
+    return EnsembleResult(t, y, status, t_eval, y_eval, nfev, nsteps, steps, naccepted, nrejected)
@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import vtk
+
+from cs530.utils.vtk_interpolation import Interpolator
+from cs530.tools.ensemble import integrate_ensemble
+
+'''
+Flow map engine: the flow map of a time-dependent vector field over each
+time window is computed once on a regular grid of seeds and cached. Long
+trajectories are then approximated by interpolating and composing the
+cached window maps, which replaces integration by one lookup per window.
+Accuracy is controlled by the grid resolution and can be measured with
+error_estimate().
+'''
+
+__all__ = [
+    'FlowMap',
+]
+
+class FlowMap:
+    def __init__(self, intp, resolution=64, steps_per_window=1, scale=1.0, method='DOP853',
+                 rtol=1.0e-6, atol=1.0e-8, bounds=None, path=None):
+        ''' intp: TimeInterpolator of the vector field.
+            resolution: number of grid points per axis (int or 3 ints).
+            steps_per_window: number of time steps of intp spanned by a window.
+            bounds: extent of the seed grid, dataset bounds by default.
+            path: optional directory where window maps are saved and reused '''
+        self.intp = intp
+        self.scale = scale
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        if bounds is None:
+            bounds = intp.data.GetBounds()
+        self.resolution = np.broadcast_to(np.asarray(resolution, dtype=int), (3,)).copy()
+        lower = np.array(bounds[0::2], dtype=float)
+        upper = np.array(bounds[1::2], dtype=float)
+        self.grid = vtk.vtkImageData()
+        self.grid.SetDimensions(self.resolution.tolist())
+        self.grid.SetOrigin(lower)
+        self.grid.SetSpacing((upper - lower) / np.maximum(self.resolution - 1, 1))
+        self.boundaries = list(intp.times[::steps_per_window])
+        if self.boundaries[-1] != intp.times[-1]:
+            self.boundaries.append(intp.times[-1])
+        # a window spans steps_per_window+1 time steps, which must all stay
+        # cached while its seeds drift apart in time
+        intp.stack = max(intp.stack, steps_per_window+1)
+        self.maps = {}
+        self.interpolators = {}
+
+    def seeds(self):
+        # (N, 3) grid points, x fastest
+        nx, ny, nz = self.resolution
+        origin = np.array(self.grid.GetOrigin())
+        spacing = np.array(self.grid.GetSpacing())
+        z, y, x = np.meshgrid(np.arange(nz), np.arange(ny), np.arange(nx), indexing='ij')
+        return origin + np.stack([x.ravel(), y.ravel(), z.ravel()], axis=-1) * spacing
+
+    def _rhs(self, t, y, hints=None):
+        values, oob = self.intp.interpolate_many(t, y, hints)
+        return self.scale*values, oob
+
+    def integrate(self, points, t0, t1):
+        # direct integration of points from t0 to t1. Positions of points
+        # leaving the domain are NaN
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if t0 == t1:
+            return points.copy()
+        span = abs(t1 - t0)
+        res = integrate_ensemble(self._rhs, (t0, t1), points, method=self.method, rtol=self.rtol, atol=self.atol,
+                                 first_step=span/100, max_step=span/4, hints=self.intp.cell_hints(len(points)))
+        result = res.y.copy()
+        result[res.status != 0] = np.nan
+        return result
+
+    def _filename(self, k, direction):
+        return os.path.join(self.path, f'map_{"fwd" if direction > 0 else "bwd"}_{k:05d}.npy')
+
+    def window_map(self, k, direction=1):
+        # (N, 3) end points of the grid seeds over window k (from
+        # boundaries[k] to boundaries[k+1], or reversed if direction < 0)
+        key = (k, 1 if direction > 0 else -1)
+        if key in self.maps:
+            return self.maps[key]
+        if self.path is not None and os.path.exists(self._filename(*key)):
+            fmap = np.load(self._filename(*key), mmap_mode='r')
+        else:
+            t0, t1 = self.boundaries[k], self.boundaries[k+1]
+            if direction < 0:
+                t0, t1 = t1, t0
+            # all time steps of the window resident before its seeds spread
+            # over it, rather than following the first one fetched
+            self.intp.slide(*self.intp.window_steps(t0, t1))
+            fmap = self.integrate(self.seeds(), t0, t1)
+            if self.path is not None:
+                np.save(self._filename(*key), fmap)
+        self.maps[key] = fmap
+        return fmap
+
+    def precompute(self, direction=1, windows=None):
+        # compute (or load) the maps of given windows, all by default,
+        # in the order of integration
+        if windows is None:
+            windows = range(len(self.boundaries)-1)
+            if direction < 0:
+                windows = windows[::-1]
+        for k in windows:
+            self.window_map(k, direction)
+
+    def _apply(self, k, direction, points):
+        # interpolated window map at points, NaN outside of the grid or
+        # where the grid seeds left the domain
+        key = (k, 1 if direction > 0 else -1)
+        if key not in self.interpolators:
+            self.interpolators[key] = Interpolator(self.grid, self.window_map(k, direction))
+        values, oob = self.interpolators[key].interpolate_many(points)
+        values[oob] = np.nan
+        return values
+
+    def trajectories(self, points, t0, t1):
+        # positions of points at t0, at every window boundary strictly
+        # between t0 and t1, and at t1. Returns times (M,) and positions
+        # (M, N, 3), NaN once a point has left the domain. Partial windows
+        # at both ends are integrated directly
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        direction = 1 if t1 >= t0 else -1
+        b = np.array(self.boundaries)
+        inner = [ k for k in range(len(b)) if direction*(b[k] - t0) > 0 and direction*(t1 - b[k]) > 0 ]
+        if direction < 0:
+            inner = inner[::-1]
+        times = [ t0 ] + [ b[k] for k in inner ] + [ t1 ]
+        positions = [ points ]
+        current = points
+        for ta, tb in zip(times[:-1], times[1:]):
+            ka = np.flatnonzero(b == ta)
+            kb = np.flatnonzero(b == tb)
+            alive = ~np.isnan(current[:, 0])
+            result = np.full_like(current, np.nan)
+            if len(ka) and len(kb) and abs(int(ka[0]) - int(kb[0])) == 1:
+                # full window: cached map
+                k = min(int(ka[0]), int(kb[0]))
+                result[alive] = self._apply(k, direction, current[alive])
+            else:
+                result[alive] = self.integrate(current[alive], ta, tb)
+            positions.append(result)
+            current = result
+        return np.array(times), np.array(positions)
+
+    def advect(self, points, t0, t1):
+        # approximate positions at t1 of points at t0 and mask of points
+        # that left the domain
+        _, positions = self.trajectories(points, t0, t1)
+        result = positions[-1]
+        return result, np.isnan(result[:, 0])
+
+    def error_estimate(self, k, direction=1, nsamples=1000, seed=0):
+        # max and RMS distance between interpolated map and direct
+        # integration of random points of the grid over window k
+        rng = np.random.default_rng(seed)
+        lower = np.array(self.grid.GetOrigin())
+        upper = lower + (self.resolution - 1) * np.array(self.grid.GetSpacing())
+        points = lower + rng.random((nsamples, 3)) * (upper - lower)
+        t0, t1 = self.boundaries[k], self.boundaries[k+1]
+        if direction < 0:
+            t0, t1 = t1, t0
+        exact = self.integrate(points, t0, t1)
+        approx = self._apply(k, direction, points)
+        err = np.linalg.norm(exact - approx, axis=-1)
+        err = err[~np.isnan(err)]
+        if len(err) == 0:
+            return { 'max': np.nan, 'rms': np.nan, 'samples': 0 }
+        return { 'max': float(np.max(err)), 'rms': float(np.sqrt(np.mean(err**2))), 'samples': len(err) }
@@ -0,0 +1,163 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+import argparse
+
+from cs530.utils.vtk_interpolation import TimeInterpolator, WindowScheduler, split_windows
+from cs530.utils.vtk_io import save_vtk_file
+from cs530.tools.ensemble import integrate_ensemble
+from cs530.tools.pathlines import find_files
+
+'''
+Finite-time Lyapunov exponent (FTLE) of a time-dependent vector field:
+seeds on a vtkImageData grid are advected over [t0, t0+T], the gradient of
+the resulting flow map is computed by finite differences on the grid and
+FTLE = log(sqrt(lambda_max(J^T J))) / |T|.
+'''
+
+__all__ = [
+    'ftle',
+]
+
+def _make_grid(bounds, resolution):
+    resolution = np.broadcast_to(np.asarray(resolution, dtype=int), (3,))
+    lower = np.array(bounds[0::2], dtype=float)
+    upper = np.array(bounds[1::2], dtype=float)
+    grid = vtk.vtkImageData()
+    grid.SetDimensions(resolution.tolist())
+    grid.SetOrigin(lower)
+    grid.SetSpacing((upper - lower) / np.maximum(resolution - 1, 1))
+    return grid
+
+def _grid_points(grid, start, stop):
+    # coordinates of grid points start to stop-1 (x fastest)
+    nx, ny, _ = grid.GetDimensions()
+    ids = np.arange(start, stop)
+    ijk = np.stack([ids % nx, (ids // nx) % ny, ids // (nx*ny)], axis=-1)
+    return np.array(grid.GetOrigin()) + ijk * np.array(grid.GetSpacing())
+
+def _flow_map(intp, grid, t0, t1, scale, method, rtol, atol, chunk_size, flowmap, verbose):
+    npts = grid.GetNumberOfPoints()
+    if flowmap is not None:
+        end = np.empty((npts, 3))
+        for start in range(0, npts, chunk_size):
+            stop = min(start + chunk_size, npts)
+            end[start:stop], _ = flowmap.advect(_grid_points(grid, start, stop), t0, t1)
+            if verbose: print(f'advected {stop}/{npts} seeds')
+        return end
+    end = _grid_points(grid, 0, npts)
+    stopped = np.zeros(npts, dtype=bool)
+    span = abs(t1 - t0)
+    def rhs(t, y, hints=None):
+        values, oob = intp.interpolate_many(t, y, hints)
+        return scale*values, oob
+    cells = intp.cell_hints(npts)
+    # one window of intp.stack time steps at a time, as in trace_pathlines,
+    # so that all particles of a window share its resident time steps
+    direction = 1 if t1 >= t0 else -1
+    boundaries = [ t0 ] + [ t for t in intp.times[::direction] if direction*(t - t0) > 0 and direction*(t1 - t) > 0 ] + [ t1 ]
+    windows = split_windows(boundaries, intp.stack)
+    scheduler = WindowScheduler(intp, [ intp.window_steps(boundaries[a], boundaries[b]) for a, b in windows ])
+    try:
+        for k, (a, b) in enumerate(windows):
+            scheduler.activate(k)
+            for start in range(0, npts, chunk_size):
+                stop = min(start + chunk_size, npts)
+                alive = start + np.flatnonzero(~stopped[start:stop])
+                if len(alive) == 0:
+                    continue
+                # particles leaving the domain keep their last position
+                hints = cells[alive] if cells is not None else None
+                res = integrate_ensemble(rhs, (boundaries[a], boundaries[b]), end[alive], method=method, 
+                                         rtol=rtol, atol=atol, first_step=span/100, max_step=span/10, hints=hints)
+                end[alive] = res.y
+                if cells is not None:
+                    cells[alive] = hints
+                stopped[alive[res.status != 0]] = True
+            if verbose: print(f'advected {npts} seeds to time {boundaries[b]}')
+    finally:
+        scheduler.close()
+    return end
+
+def _ftle_from_flow_map(end, dims, spacing, T, chunk_size):
+    nx, ny, nz = dims
+    phi = end.reshape((nz, ny, nx, 3))
+    values = np.zeros((nz, ny, nx))
+    # derivatives along degenerate axes are zero
+    axes = [ (a, s) for a, (n, s) in enumerate(zip((nz, ny, nx), spacing[::-1])) if n > 1 ]
+    # slabs of z-slices (with one ghost slice on each side) bound memory
+    nslices = max(1, chunk_size // max(nx*ny, 1))
+    for k0 in range(0, nz, nslices):
+        k1 = min(k0 + nslices, nz)
+        g0, g1 = max(k0-1, 0), min(k1+1, nz)
+        J = np.zeros((g1-g0, ny, nx, 3, 3))
+        for axis, h in axes:
+            if axis == 0 and g1 - g0 < 2:
+                continue
+            # column of J: derivative of phi along x, y or z
+            J[..., :, 2-axis] = np.gradient(phi[g0:g1], h, axis=axis)
+        J = J[k0-g0:k1-g0]
+        C = np.einsum('...ki,...kj->...ij', J, J)
+        # stencils touching points lost by a flow map (NaN) get FTLE 0
+        C[~np.isfinite(C).all(axis=(-2, -1))] = 0
+        lmax = np.linalg.eigvalsh(C)[..., -1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values[k0:k1] = np.log(np.sqrt(np.maximum(lmax, 0))) / abs(T)
+    values[~np.isfinite(values)] = 0
+    return values.ravel()
+
+def ftle(intp, t0, T, resolution=64, bounds=None, grid=None, scale=1.0, method='DOP853',
+         rtol=1.0e-5, atol=1.0e-7, chunk_size=1<<18, flowmap=None, verbose=False):
+    ''' FTLE field of TimeInterpolator intp over [t0, t0+T] (T < 0 for
+        backward FTLE), returned as point scalars 'ftle' of a vtkImageData.
+        Seeds are the points of grid or of a regular grid with given
+        resolution covering bounds (dataset bounds by default). Seeds are
+        advected chunk_size at a time, one window of intp.stack time steps
+        after the other, or with a FlowMap when one is given. Trajectories
+        leaving the domain stop at the boundary, except with a FlowMap,
+        which loses them (FTLE 0 around them) '''
+    if T == 0:
+        raise ValueError('FTLE requires a non-zero integration time')
+    if grid is None:
+        if bounds is None:
+            bounds = intp.data.GetBounds()
+        grid = _make_grid(bounds, resolution)
+    else:
+        geometry = vtk.vtkImageData()
+        geometry.CopyStructure(grid)
+        grid = geometry
+    end = _flow_map(intp, grid, t0, t0+T, scale, method, rtol, atol, chunk_size, flowmap, verbose)
+    values = _ftle_from_flow_map(end, grid.GetDimensions(), np.array(grid.GetSpacing()), T, chunk_size)
+    array = numpy_support.numpy_to_vtk(values)
+    array.SetName('ftle')
+    grid.GetPointData().SetScalars(array)
+    flow_map = numpy_support.numpy_to_vtk(end)
+    flow_map.SetName('flow_map')
+    grid.GetPointData().AddArray(flow_map)
+    return grid
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the FTLE field of a time dependent vector field')
+    parser.add_argument('-p', '--path', type=str, default='.', help='Path of data files')
+    parser.add_argument('-f', '--filenames', type=str, nargs='+', required=True, help='Files containing vector field timesteps (can be a unix pattern)')
+    parser.add_argument('-t', '--times', type=float, nargs='+', help='Time coordinates of individual time steps')
+    parser.add_argument('--delta_t', type=float, default=1, help='Time interval between timesteps (if uniform)')
+    parser.add_argument('--t_init', type=float, default=0, help='Time coordinate of first time step')
+    parser.add_argument('-v', '--value_name', type=str, default='vectors', help='Name of vector field variable')
+    parser.add_argument('-x', '--scale', type=float, default=1, help='Scaling factor for velocity values')
+    parser.add_argument('--t0', type=float, required=True, help='Start time of advection')
+    parser.add_argument('-T', '--duration', type=float, required=True, help='Advection time (negative for backward FTLE)')
+    parser.add_argument('-r', '--resolution', type=int, nargs='+', default=[64], help='Resolution of the seed grid')
+    parser.add_argument('--chunk_size', type=int, default=1<<18, help='Number of seeds advected at once')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Output file (.vti)')
+    parser.add_argument('--verbose', action='store_true', help='Print progress information')
+    args = parser.parse_args()
+
+    filenames = find_files(args.path, args.filenames)
+    if args.times is None:
+        args.times = [ args.t_init + n*args.delta_t for n, _ in enumerate(filenames) ]
+    intp = TimeInterpolator(args.times, filenames, attributes=[args.value_name])
+    resolution = args.resolution if len(args.resolution) == 3 else args.resolution[0]
+    field = ftle(intp, args.t0, args.duration, resolution=resolution, scale=args.scale,
+                 chunk_size=args.chunk_size, verbose=args.verbose)
+    save_vtk_file(field, args.output)
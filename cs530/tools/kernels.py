@@ -0,0 +1,525 @@
+import math
+import numpy as np
+from scipy.integrate import RK45
+
+from cs530.utils.vtk_interpolation import _UniformGrid, _RectilinearGrid
+from cs530.tools.ensemble import SUCCESS, LEFT_DOMAIN
+
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
+'''
+Compiled particle advection kernels for vector fields sampled on uniform
+grids: trilinear sampling (blended between two time steps) and fixed (RK4)
+or adaptive (Dormand-Prince 5(4)) Runge-Kutta steps, parallel over particles.
+The kernels are compiled with numba when it is installed; otherwise the same
+operations, in the same order, run as batched NumPy code with identical results.
+'''
+
+__all__ = [
+    'HAVE_NUMBA',
+    'sample_uniform',
+    'advect_particles',
+]
+
+HAVE_NUMBA = numba is not None
+
+_TOLERANCE = _UniformGrid.tolerance
+
+# Dormand-Prince tableau with the FSAL stage as 7th row
+_DP_A = np.zeros((7, 7))
+_DP_A[:6, :5] = RK45.A
+_DP_A[6, :6] = RK45.B
+_DP_C = np.append(RK45.C, 1.0)
+_DP_E = RK45.E
+
+def _jit(f):
+    if numba is None:
+        return f
+    return numba.njit(parallel=True, cache=True)(f)
+
+def _jit_inline(f):
+    if numba is None:
+        return f
+    return numba.njit(cache=True, inline='always')(f)
+
+def _use_numba(backend):
+    if backend not in ['auto', 'numba', 'numpy']:
+        raise ValueError(f'Unknown backend {backend}')
+    if backend == 'numba' and numba is None:
+        raise ImportError('numba is not installed')
+    return backend != 'numpy' and numba is not None
+
+# compiled kernels (plain Python, and not used, without numba)
+
+@_jit_inline
+def _axis(x, o, h, n):
+    # cell index and local coordinate along one axis, False outside
+    s = (x - o) / h
+    if n == 1:
+        return 0, 0.0, abs(s) <= _TOLERANCE
+    if not (s >= -_TOLERANCE and s <= n - 1 + _TOLERANCE):
+        return 0, 0.0, False
+    i = min(max(int(math.floor(s)), 0), n - 2)
+    return i, min(max(s - i, 0.0), 1.0), True
+
+@_jit_inline
+def _sample(f0, f1, u, origin, spacing, dims, x, y, z, out):
+    # velocity (first 3 columns of packed f0 and f1 blended with weight u)
+    # at (x, y, z) written to out. False outside of the grid
+    i, wx, okx = _axis(x, origin[0], spacing[0], dims[0])
+    j, wy, oky = _axis(y, origin[1], spacing[1], dims[1])
+    k, wz, okz = _axis(z, origin[2], spacing[2], dims[2])
+    if not (okx and oky and okz):
+        return False
+    sx = 1 if dims[0] > 1 else 0
+    sy = dims[0] if dims[1] > 1 else 0
+    sz = dims[0]*dims[1] if dims[2] > 1 else 0
+    base = i + dims[0]*(j + dims[1]*k)
+    for c in range(3):
+        out[c] = 0.0
+    for b in range(8):
+        bx = b & 1
+        by = (b >> 1) & 1
+        bz = (b >> 2) & 1
+        w = (wx if bx else 1.0-wx) * (wy if by else 1.0-wy) * (wz if bz else 1.0-wz)
+        if w == 0.0:
+            continue
+        id = base + bx*sx + by*sy + bz*sz
+        for c in range(3):
+            out[c] += w*((1.0-u)*f0[id, c] + u*f1[id, c])
+    return True
+
+@_jit
+def _sample_kernel(f0, f1, u, origin, spacing, dims, points, values, oob):
+    for p in prange(points.shape[0]):
+        oob[p] = not _sample(f0, f1, u, origin, spacing, dims,
+                             points[p, 0], points[p, 1], points[p, 2], values[p])
+
+@_jit
+def _rk4_kernel(points, status, t0, t1, nsteps, f0, f1, ta, tb, origin, spacing, dims, scale, counts):
+    # nsteps RK4 steps from t0 to t1 for particles with status SUCCESS.
+    # Particles leaving the grid keep their last position. Steps taken
+    # are added to counts[:, 0]
+    h = (t1 - t0) / nsteps
+    span = tb - ta
+    for p in prange(points.shape[0]):
+        if status[p] != 0:
+            continue
+        k = np.empty((4, 3))
+        y = np.empty(3)
+        t = t0
+        for n in range(nsteps):
+            ok = True
+            for s in range(4):
+                c = 0.0 if s == 0 else (1.0 if s == 3 else 0.5)
+                for d in range(3):
+                    y[d] = points[p, d] + (c*h*k[s-1, d] if s > 0 else 0.0)
+                u = min(max((t + c*h - ta) / span, 0.0), 1.0)
+                if not _sample(f0, f1, u, origin, spacing, dims, y[0], y[1], y[2], k[s]):
+                    ok = False
+                    break
+                for d in range(3):
+                    k[s, d] *= scale
+            if not ok:
+                status[p] = 1
+                break
+            for d in range(3):
+                points[p, d] += h/6.0*(k[0, d] + 2.0*k[1, d] + 2.0*k[2, d] + k[3, d])
+            counts[p, 0] += 1
+            t += h
+
+@_jit
+def _rk45_kernel(points, status, steps, t0, t1, f0, f1, ta, tb, origin, spacing, dims, scale,
+                 A, C, E, rtol, atol, hmin, counts):
+    # adaptive Dormand-Prince 5(4) from t0 to t1 with per-particle step
+    # sizes steps (updated in place). A stage outside of the grid rejects
+    # the step; particles whose step falls below hmin have left the domain.
+    # Accepted and rejected steps are added to counts[:, 0] and counts[:, 1]
+    direction = 1.0 if t1 >= t0 else -1.0
+    span = tb - ta
+    for p in prange(points.shape[0]):
+        if status[p] != 0:
+            continue
+        K = np.empty((7, 3))
+        y = np.empty(3)
+        ynew = np.empty(3)
+        t = t0
+        h = steps[p]
+        fresh = True
+        while direction*(t1 - t) > 0:
+            # h: proposed step size, hs: signed step taken
+            last = h >= abs(t1 - t)
+            hs = direction*min(h, abs(t1 - t))
+            ok = True
+            if fresh:
+                u = min(max((t - ta) / span, 0.0), 1.0)
+                ok = _sample(f0, f1, u, origin, spacing, dims, points[p, 0], points[p, 1], points[p, 2], K[0])
+            for s in range(1, 7):
+                if not ok:
+                    break
+                for d in range(3):
+                    acc = 0.0
+                    for j in range(s):
+                        acc += A[s, j]*K[j, d]
+                    y[d] = points[p, d] + hs*scale*acc
+                if s == 6:
+                    for d in range(3):
+                        ynew[d] = y[d]
+                u = min(max((t + C[s]*hs - ta) / span, 0.0), 1.0)
+                ok = _sample(f0, f1, u, origin, spacing, dims, y[0], y[1], y[2], K[s])
+            if not ok:
+                # stage outside of the grid: shrink the step
+                counts[p, 1] += 1
+                fresh = True
+                h = 0.5*abs(hs)
+                if h < hmin:
+                    status[p] = 1
+                    break
+                continue
+            err = 0.0
+            for d in range(3):
+                e = 0.0
+                for j in range(7):
+                    e += E[j]*K[j, d]
+                sc = atol + rtol*max(abs(points[p, d]), abs(ynew[d]))
+                err += (hs*scale*e/sc)**2
+            err = math.sqrt(err/3.0)
+            if err < 1.0:
+                counts[p, 0] += 1
+                factor = 10.0 if err == 0.0 else min(10.0, 0.9*err**-0.2)
+                t = t1 if last else t + hs
+                for d in range(3):
+                    points[p, d] = ynew[d]
+                    K[0, d] = K[6, d]
+                fresh = False
+                h = max(h, abs(hs)*factor) if last else h*factor
+            else:
+                counts[p, 1] += 1
+                h = abs(hs)*max(0.2, 0.9*err**-0.2)
+                if h < hmin:
+                    status[p] = 1
+                    break
+        steps[p] = h
+
+# NumPy fallbacks: the operations of the kernels above, in the same order,
+# on all particles at once, so that both backends give identical results
+
+def _axes_numpy(points, origin, spacing, dims):
+    # _axis along the 3 axes at once: (N,3) cell indices, local coordinates
+    # and inside flags
+    s = (points - origin) / spacing
+    flat = dims == 1
+    inside = np.where(flat, np.abs(s) <= _TOLERANCE, (s >= -_TOLERANCE) & (s <= dims - 1 + _TOLERANCE))
+    i = np.minimum(np.maximum(np.floor(np.where(inside, s, 0.0)), 0), np.maximum(dims - 2, 0))
+    w = np.where(flat, 0.0, np.minimum(np.maximum(s - i, 0.0), 1.0))
+    return i.astype(np.int64), w, inside
+
+# corner b of a cell: offsets b & 1, (b >> 1) & 1, (b >> 2) & 1 along x, y, z
+_CORNERS = (np.arange(8)[:, None] >> np.arange(3)) & 1
+
+def _sample_numpy(f0, f1, u, origin, spacing, dims, points):
+    # u: blending weight, scalar or per point
+    i, w, inside = _axes_numpy(points, origin, spacing, dims)
+    strides = np.array([1, dims[0], dims[0]*dims[1]]) * (dims > 1)
+    # (N,8) corner weights, products taken in the same order as in _sample
+    w = np.stack([1.0-w, w], axis=1)
+    bx, by, bz = _CORNERS.T
+    w = w[:, bx, 0] * w[:, by, 1] * w[:, bz, 2]
+    ids = (i[:, 0] + dims[0]*(i[:, 1] + dims[1]*i[:, 2]))[:, None] + _CORNERS @ strides
+    # float64 blend, as in the kernels, also for float32 fields
+    u = np.asarray(u, dtype=float).reshape(-1, 1, 1)
+    w = w[..., None]
+    terms = np.where(w != 0.0, w*((1.0-u)*f0[ids, :3] + u*f1[ids, :3]), 0.0)
+    # corners summed one after the other, as in the kernels
+    values = np.zeros((len(points), 3))
+    for b in range(8):
+        values += terms[:, b]
+    return values, ~np.all(inside, axis=1)
+
+def _rk4_numpy(points, status, t0, t1, nsteps, f0, f1, ta, tb, origin, spacing, dims, scale, counts):
+    h = (t1 - t0) / nsteps
+    span = tb - ta
+    alive = np.flatnonzero(status == SUCCESS)
+    t = t0
+    for _ in range(nsteps):
+        if len(alive) == 0:
+            break
+        y = points[alive]
+        k = []
+        lost = np.zeros(len(alive), dtype=bool)
+        for s in range(4):
+            c = 0.0 if s == 0 else (1.0 if s == 3 else 0.5)
+            u = min(max((t + c*h - ta) / span, 0.0), 1.0)
+            values, oob = _sample_numpy(f0, f1, u, origin, spacing, dims, y + c*h*k[s-1] if s > 0 else y)
+            k.append(values*scale)
+            lost |= oob
+        points[alive[~lost]] = (y + h/6.0*(k[0] + 2.0*k[1] + 2.0*k[2] + k[3]))[~lost]
+        status[alive[lost]] = LEFT_DOMAIN
+        alive = alive[~lost]
+        counts[alive, 0] += 1
+        t += h
+
+def _rk45_numpy(points, status, steps, t0, t1, f0, f1, ta, tb, origin, spacing, dims, scale,
+                A, C, E, rtol, atol, hmin, counts):
+    # A particle with a stage outside of the grid halves its step until all
+    # stages are inside or the step falls below hmin, which takes up to ~40
+    # attempts when it leaves the domain. Instead of one attempt per pass,
+    # such particles try the whole sequence of halved steps at once and keep
+    # the first one that the kernel would have accepted
+    direction = 1.0 if t1 >= t0 else -1.0
+    span = tb - ta
+    entry = np.flatnonzero(status == SUCCESS)
+    K = np.empty((len(points), 7, 3))
+    t = np.full(len(points), float(t0))
+    h = steps.copy()
+    fresh = np.ones(len(points), dtype=bool)
+    # last attempt had a stage outside of the grid
+    halving = np.zeros(len(points), dtype=bool)
+    active = entry
+    while True:
+        active = active[(status[active] == SUCCESS) & (direction*(t1 - t[active]) > 0)]
+        if len(active) == 0:
+            break
+        p = active
+        remaining = np.abs(t1 - t[p])
+        # attempts: step proposal hc of particle p[owner], round after round
+        owner, hc, rounds = [ np.arange(len(p)) ], [ h[p] ], [ np.zeros(len(p), dtype=np.int64) ]
+        hlast = h[p].copy()
+        sub = np.flatnonzero(halving[p])
+        hk = hlast[sub]
+        k = 0
+        while len(sub):
+            k += 1
+            hk = 0.5*np.minimum(hk, remaining[sub])
+            keep = hk >= hmin
+            sub, hk = sub[keep], hk[keep]
+            owner.append(sub)
+            hc.append(hk)
+            rounds.append(np.full(len(sub), k))
+            hlast[sub] = hk
+        owner, hc, rounds = np.concatenate(owner), np.concatenate(hc), np.concatenate(rounds)
+        # h: proposed step sizes, hs: signed steps taken
+        last = hc >= remaining[owner]
+        hs = direction*np.minimum(hc, remaining[owner])
+        first = np.flatnonzero(fresh[p])
+        inside = np.ones(len(p), dtype=bool)
+        if len(first):
+            u = np.minimum(np.maximum((t[p[first]] - ta) / span, 0.0), 1.0)
+            K[p[first], 0], oob = _sample_numpy(f0, f1, u, origin, spacing, dims, points[p[first]])
+            inside[first] = ~oob
+        ok = inside[owner]
+        stages = np.empty((len(owner), 7, 3))
+        stages[:, 0] = K[p[owner], 0]
+        ynew = np.empty((len(owner), 3))
+        for s in range(1, 7):
+            rows = np.flatnonzero(ok)
+            acc = 0.0
+            for j in range(s):
+                acc = acc + A[s, j]*stages[rows, j]
+            y = points[p[owner[rows]]] + hs[rows, None]*scale*acc
+            if s == 6:
+                ynew[rows] = y
+            u = np.minimum(np.maximum((t[p[owner[rows]]] + C[s]*hs[rows] - ta) / span, 0.0), 1.0)
+            stages[rows, s], oob = _sample_numpy(f0, f1, u, origin, spacing, dims, y)
+            ok[rows] = ~oob
+        # first attempt of each particle with all stages inside. Every
+        # attempt before it is a rejected step
+        order = np.argsort(owner, kind='stable')
+        valid = order[ok[order]]
+        winners, index = np.unique(owner[valid], return_index=True)
+        win = valid[index]
+        failed = np.ones(len(p), dtype=bool)
+        failed[winners] = False
+        # stage outside of the grid in every attempt: shrink the step
+        lost = p[failed]
+        counts[lost, 1] += np.bincount(owner, minlength=len(p))[failed]
+        fresh[lost] = True
+        halving[lost] = True
+        h[lost] = 0.5*np.minimum(hlast[failed], remaining[failed])
+        status[lost[h[lost] < hmin]] = LEFT_DOMAIN
+        q = p[winners]
+        counts[q, 1] += rounds[win]
+        halving[q] = False
+        h[q] = hc[win]
+        K[q] = stages[win]
+        hs, last, ynew = hs[win], last[win], ynew[win]
+        e = 0.0
+        for j in range(7):
+            e = e + E[j]*K[q, j]
+        sc = atol + rtol*np.maximum(np.abs(points[q]), np.abs(ynew))
+        scaled = hs[:, None]*scale*e/sc
+        err = 0.0
+        for d in range(3):
+            err = err + scaled[:, d]**2
+        err = np.sqrt(err/3.0)
+        # libm pow, as in the kernel (numpy's vectorized power may differ in
+        # the last bit), and python min/max semantics, NaN included
+        growth = np.full(len(err), np.inf)
+        nonzero = err != 0.0
+        growth[nonzero] = [ math.pow(x, -0.2) for x in err[nonzero].tolist() ]
+        growth *= 0.9
+        good = err < 1.0
+        a = q[good]
+        counts[a, 0] += 1
+        factor = np.where(err[good] == 0.0, 10.0, np.where(growth[good] < 10.0, growth[good], 10.0))
+        t[a] = np.where(last[good], t1, t[a] + hs[good])
+        points[a] = ynew[good]
+        K[a, 0] = K[a, 6]
+        fresh[a] = False
+        grown = np.abs(hs[good])*factor
+        h[a] = np.where(last[good], np.where(grown > h[a], grown, h[a]), h[a]*factor)
+        r = q[~good]
+        counts[r, 1] += 1
+        h[r] = np.abs(hs[~good])*np.where(growth[~good] > 0.2, growth[~good], 0.2)
+        status[r[h[r] < hmin]] = LEFT_DOMAIN
+    steps[entry] = h[entry]
+
+def _uniform_grid(intp):
+    grid = getattr(intp, 'grid', None)
+    if not isinstance(grid, _UniformGrid) or isinstance(grid, _RectilinearGrid):
+        raise ValueError('Compiled kernels require a field on an axis-aligned vtkImageData')
+    return grid
+
+def sample_uniform(intp, points, t=None, backend='auto'):
+    ''' velocity (first 3 components of the fields) of Interpolator or
+        TimeInterpolator intp over a uniform grid at (N, 3) points, at time t
+        for a TimeInterpolator. Returns (N, 3) values (NaN outside) and the
+        out-of-bounds mask '''
+    grid = _uniform_grid(intp)
+    points = np.ascontiguousarray(points, dtype=float).reshape(-1, 3)
+    if t is None:
+        u, f0, f1 = 0.0, intp.packed, intp.packed
+    else:
+        u, f0, f1 = intp.fetch(t)
+    if _use_numba(backend):
+        values = np.empty((len(points), 3))
+        oob = np.empty(len(points), dtype=bool)
+        _sample_kernel(f0, f1, float(u), grid.origin, grid.spacing, grid.dims.astype(np.int64), points, values, oob)
+    else:
+        values, oob = _sample_numpy(f0, f1, float(u), grid.origin, grid.spacing, grid.dims, points)
+    values[oob] = np.nan
+    return values, oob
+
+def _intervals(intp, t0, t1):
+    # (ta, tb, start, stop, i): time step interval [ta, tb] = [t_{i-1}, t_i]
+    # and the part [start, stop] of [t0, t1] that it covers, in order
+    if not hasattr(intp, 'times'):
+        return [ (t0, t1, t0, t1, None) ]
+    times = intp.times
+    if min(t0, t1) < times[0] or max(t0, t1) > times[-1]:
+        raise ValueError(f'Times outside of temporal range {times[0]} - {times[-1]}')
+    lo, hi = min(t0, t1), max(t0, t1)
+    i0 = intp.step_index(lo)
+    i1 = max(int(np.searchsorted(times, hi, side='left')), i0)
+    parts = [ (times[i-1], times[i], max(lo, times[i-1]), min(hi, times[i]), i) for i in range(i0, i1+1) ]
+    if t1 < t0:
+        parts = [ (ta, tb, stop, start, i) for ta, tb, start, stop, i in parts[::-1] ]
+    return parts
+
+def advect_particles(intp, points, t0, t1, method='RK4', dt=None, rtol=1.0e-3, atol=1.0e-6,
+           scale=1.0, backend='auto', counts=None):
+    ''' positions at t1 of particles at points (N, 3) at t0, advected in the
+        velocity (first 3 components) of Interpolator or TimeInterpolator
+        intp over a uniform grid.
+        method: 'RK4' with fixed step dt (by default a tenth of the time
+        step of the data, or of t1-t0 for a steady field) or 'RK45'
+        (adaptive Dormand-Prince with tolerances rtol, atol).
+        backend: 'numba', 'numpy' or 'auto' (numba if installed).
+        counts: optional integer array of size 2 to which the numbers of
+        accepted and rejected steps are added.
+        Returns positions and status (SUCCESS, or LEFT_DOMAIN for particles
+        stopped at their last position inside the grid) '''
+    if method not in ['RK4', 'RK45']:
+        raise ValueError(f'Unsupported method {method} (available: RK4, RK45)')
+    return _advect(intp, points, t0, t1, method, dt, rtol, atol, scale, _use_numba(backend), counts)
+
+def _advect(intp, points, t0, t1, method, dt, rtol, atol, scale, jit, counts):
+    # advect_particles with the kernels (compiled, or run as plain Python
+    # without numba) if jit is set, with their NumPy versions otherwise
+    grid = _uniform_grid(intp)
+    points = np.array(points, dtype=float).reshape(-1, 3)
+    status = np.full(len(points), SUCCESS, dtype=np.int64)
+    if t0 == t1:
+        return points, status
+    dims = grid.dims.astype(np.int64)
+    steps = None
+    # accepted and rejected steps of each particle
+    taken = np.zeros((len(points), 2), dtype=np.int64)
+    for ta, tb, start, stop, i in _intervals(intp, t0, t1):
+        if start == stop:
+            continue
+        if i is None:
+            f0 = f1 = intp.packed
+        else:
+            _, f0, f1 = intp.fetch(0.5*(start + stop), i)
+        if method == 'RK4':
+            h = dt if dt is not None else (tb - ta)/10
+            nsteps = max(int(math.ceil(abs(stop - start)/h - 1.0e-9)), 1)
+            if jit:
+                _rk4_kernel(points, status, start, stop, nsteps, f0, f1, ta, tb,
+                            grid.origin, grid.spacing, dims, scale, taken)
+            else:
+                _rk4_numpy(points, status, start, stop, nsteps, f0, f1, ta, tb,
+                           grid.origin, grid.spacing, dims, scale, taken)
+        else:
+            if steps is None:
+                steps = np.full(len(points), abs(t1 - t0)/100)
+            rk45 = _rk45_kernel if jit else _rk45_numpy
+            rk45(points, status, steps, start, stop, f0, f1, ta, tb, grid.origin, grid.spacing, dims, scale,
+                 _DP_A, _DP_C, _DP_E, rtol, atol, 1.0e-12*abs(t1 - t0), taken)
+    if counts is not None:
+        counts += taken.sum(axis=0)
+    return points, status
+
+def main(number=50):
+    # backend agreement: particles advected in an unsteady field with the
+    # kernels and with their NumPy versions must end at identical positions,
+    # with identical status and step counts. Without numba the kernels run
+    # as plain Python (slowly)
+    import tempfile
+    import vtk
+    from cs530.utils.vtk_dataset import add_vectors
+    from cs530.utils.vtk_io import save_vtk_file
+    from cs530.utils.vtk_interpolation import TimeInterpolator
+
+    dims, spacing = (12, 10, 8), (0.2, 0.25, 0.3)
+    x, y, z = np.meshgrid(*[ s*np.arange(n) for n, s in zip(dims, spacing) ], indexing='ij')
+    x, y, z = [ c.ravel(order='F') for c in (x, y, z) ]
+    times = [ 0.0, 1.0, 2.5, 3.0 ]
+    with tempfile.TemporaryDirectory() as path:
+        filenames = []
+        for k, t in enumerate(times):
+            image = vtk.vtkImageData()
+            image.SetDimensions(*dims)
+            image.SetSpacing(*spacing)
+            # rotation about a drifting center
+            vectors = np.stack([ -(y - 1.1 - 0.1*t), x - 1.1, 0.2*np.sin(z + t) ], axis=1)
+            add_vectors(image, vectors, name='vectors', dtype=np.float64)
+            filenames.append(f'{path}/field_{k}.vti')
+            save_vtk_file(image, filenames[-1])
+        # float64 fields: plain Python kernels would blend float32 fields in float32
+        intp = TimeInterpolator(times, filenames, stack=len(times), dtype=np.float64)
+        rng = np.random.default_rng(0)
+        points = rng.random((number, 3))*(np.array(dims) - 1)*spacing
+        for method in ['RK4', 'RK45']:
+            for t0, t1 in [ (0.2, 2.9), (2.9, 0.2) ]:
+                results = []
+                for jit in [ True, False ]:
+                    counts = np.zeros(2, dtype=np.int64)
+                    end, status = _advect(intp, points, t0, t1, method, None, 1.0e-3, 1.0e-6, 1.5, jit, counts)
+                    results.append((end, status, counts))
+                (a, sa, ca), (b, sb, cb) = results
+                same = np.array_equal(a, b) and np.array_equal(sa, sb) and np.array_equal(ca, cb)
+                print(f'{method} from {t0} to {t1}: {"identical" if same else "different"} results '
+                      f'(max difference {np.abs(a - b).max()}, {np.count_nonzero(sa)} particles left, '
+                      f'{ca[0]} accepted and {ca[1]} rejected steps)')
+                if not same:
+                    raise AssertionError(f'{method} backends disagree')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os
+import json
+import numpy as np
+
+from cs530.tools.curves import CurveSet
+
+'''
+Chunked on-disk storage of pathline samples. Each chunk holds the samples
+produced over one time window as three .npy files (pathline ids, times and
+positions) with ids in increasing order, so that memory use while tracing
+is bounded by a single window. Chunks are memory-mapped when read back.
+'''
+
+__all__ = [
+    'PathlineWriter',
+    'PathlineStore',
+]
+
+_MANIFEST = 'manifest.json'
+
+def _chunk_filename(name, what):
+    return f'{name}_{what}.npy'
+
+class PathlineWriter:
+    ''' Appends chunks of samples to directory path. Several writers with
+        distinct parts (e.g., one per worker process) can share a directory;
+        their chunks are gathered by the writer that calls close() '''
+    def __init__(self, path, part=0):
+        self.path = path
+        self.part = part
+        self.chunks = []
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, ids, times, points):
+        # samples of a time window, ordered by pathline id
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        name = f'{self.part:04d}_{len(self.chunks):05d}'
+        np.save(os.path.join(self.path, _chunk_filename(name, 'ids')), ids)
+        np.save(os.path.join(self.path, _chunk_filename(name, 'times')), np.asarray(times, dtype=float))
+        np.save(os.path.join(self.path, _chunk_filename(name, 'points')), np.asarray(points, dtype=float))
+        self.chunks.append({ 'name': name, 'part': self.part,
+                             'first': int(ids[0]), 'last': int(ids[-1]), 'size': len(ids) })
+
+    def extend(self, chunks):
+        # register chunks written by other writers
+        self.chunks.extend(chunks)
+
+    def close(self, npathlines):
+        chunks = sorted(self.chunks, key=lambda c: c['name'])
+        manifest = { 'npathlines': int(npathlines),
+                     'npoints': int(sum(c['size'] for c in chunks)),
+                     'chunks': chunks }
+        with open(os.path.join(self.path, _MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return PathlineStore(self.path)
+
+class PathlineStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _MANIFEST)) as f:
+            manifest = json.load(f)
+        self.npathlines = manifest['npathlines']
+        self.npoints = manifest['npoints']
+        self.chunks = manifest['chunks']
+
+    def __len__(self):
+        return self.npathlines
+
+    def read_chunk(self, k):
+        # read-only memory maps of ids, times and points of chunk k
+        name = self.chunks[k]['name']
+        return tuple(np.load(os.path.join(self.path, _chunk_filename(name, what)), mmap_mode='r')
+                     for what in ['ids', 'times', 'points'])
+
+    def pathline(self, i):
+        # points and times of pathline i, in chronological order
+        points = []
+        times = []
+        for k, chunk in enumerate(self.chunks):
+            if chunk['first'] > i or chunk['last'] < i:
+                continue
+            ids, t, p = self.read_chunk(k)
+            lo, hi = np.searchsorted(ids, [i, i+1])
+            points.append(p[lo:hi])
+            times.append(t[lo:hi])
+        if not points:
+            return np.empty((0, 3)), np.empty(0)
+        return np.concatenate(points), np.concatenate(times)
+
+    def counts(self):
+        # number of samples of each pathline
+        counts = np.zeros(self.npathlines, dtype=np.int64)
+        for k in range(len(self.chunks)):
+            counts += np.bincount(self.read_chunk(k)[0], minlength=self.npathlines)
+        return counts
+
+    def _gather(self):
+        # all samples ordered by pathline, and curve offsets
+        counts = self.counts()
+        strides = np.concatenate([[0], np.cumsum(counts)])
+        all_pts = np.empty((self.npoints, 3))
+        all_times = np.empty(self.npoints)
+        # chunks are chronological per part, and each part holds a range of ids
+        cursor = strides[:-1].copy()
+        for k in range(len(self.chunks)):
+            ids, t, p = self.read_chunk(k)
+            rank = np.arange(len(ids)) - np.searchsorted(ids, ids)
+            dest = cursor[ids] + rank
+            all_pts[dest] = p
+            all_times[dest] = t
+            cursor += np.bincount(ids, minlength=self.npathlines)
+        return all_pts, all_times, strides
+
+    def to_curves(self):
+        # in-memory CurveSet with a 'time' attribute
+        all_pts, all_times, strides = self._gather()
+        return CurveSet.from_arrays(all_pts, strides, time=all_times)
+
+    def to_arrays(self):
+        # in-memory (all_pts, all_times, strides, line_ids), as returned by
+        # trace_pathlines without output
+        curves = self.to_curves()
+        return curves.points, curves.attribute('time'), curves.offsets.tolist(), curves.line_ids()
@@ -7,18 +7,28 @@ import random
 from tqdm import tqdm
 import os
 import fnmatch
+import json
+import bisect
+from concurrent.futures import ProcessPoolExecutor, wait
 
 __all__ = [
     'trace_pathlines',
+    'trace_streaklines',
+    'trace_timelines',
 ]
 
 import sys
 
 from cs530.utils.vtk_interpolation import *
 from cs530.utils.vtk_io import read_vtk_file
-from cs530.utils.vtk_dataset import make_points, add_scalars, add_polylines
+from cs530.utils.vtk_timeseries import SharedTimeSeries
+from cs530.tools.pathline_store import PathlineWriter
+from cs530.tools.curves import CurveSet
 from cs530.utils.vtk_colors import make_colormap
 from cs530.utils.vtk_rendering import make_actor, make_render_kit
+from cs530.tools.ensemble import integrate_ensemble
+from cs530.utils.vtk_profiling import Profiler, NULL_PROFILER
+from cs530.tools.kernels import advect_particles
 
 def find_files(path, patterns):
     filenames = []
@@ -40,88 +50,575 @@ class OutOfBoundsEvent:
                    y[2]-self.bounds[4], self.bounds[5]-y[2])
         return d
 
-def trace_pathlines(seed, times, filenames, value_name, **kwargs):
-    depth = kwargs.get('depth', 3)
-    scale = kwargs.get('scale', 1.0)
-    t_init = kwargs.get('t_init', 0.0)
-    verbose = kwargs.get('verbose', False)
+def _velocity(intp, scale):
+    # batched right-hand side for integrate_ensemble
+    def rhs(t, y, hints=None):
+        values, oob = intp.interpolate_many(t, y, hints)
+        return scale*values, oob
+    return rhs
+
+def _trace_scipy(intp, scale, event, t_span, seeds, steps, method, dt, record_steps=False, profiler=NULL_PROFILER):
+    # reference integrator: one solve_ivp call per seed. Returns dense output
+    # samples at given times and, with record_steps, the solver steps.
+    # Steps and RHS evaluations are counted in profiler
+    def rhs(t, y):
+        return scale*intp(t, y)
+    samples = np.full((len(steps), len(seeds), 3), np.nan)
+    last = np.array(seeds, dtype=float)
+    status = np.zeros(len(seeds), dtype=int)
+    recorded = []
+    for i, aseed in enumerate(tqdm(seeds)):
+        intp.reset_hint()
+        try:
+            res = sp.integrate.solve_ivp(
+                rhs, t_span=t_span, y0=aseed, method=method, 
+                dense_output=True, events=event, first_step=abs(dt), max_step=20*abs(dt),
+                rtol=1.0e-3, atol=1.0e-6)
+        except Exception:
+            status[i] = 1
+            continue
+        # one vectorized dense output evaluation for all sampling times
+        inside = (steps - res.sol.t_min) * (steps - res.sol.t_max) <= 0
+        if np.any(inside):
+            samples[inside, i] = res.sol(steps[inside]).T
+        # solve_ivp does not report its rejected steps
+        profiler.count('solver_steps', len(res.t)-1)
+        profiler.count('rhs_evaluations', res.nfev)
+        profiler.count('points_evaluated', res.nfev)
+        if record_steps:
+            recorded.append((np.full(len(res.t)-1, i), res.t[1:], res.y[:, 1:].T))
+        last[i] = res.y[:, -1]
+        if res.t[-1] != t_span[1]:
+            status[i] = 1
+    solver_steps = None
+    if record_steps:
+        solver_steps = tuple(np.concatenate([ r[k] for r in recorded ] + [ empty ]) for k, empty in 
+                             enumerate([ np.empty(0, dtype=np.int64), np.empty(0), np.empty((0, 3)) ]))
+    return samples, last, status, solver_steps
+
+def _trace_kernel(intp, scale, t_span, seeds, steps, method, dt, profiler=NULL_PROFILER):
+    # compiled kernels (see advect_particles), advancing all seeds from one
+    # sampling time to the next. Returns samples, last positions and status.
+    # Accepted and rejected steps are counted in profiler
+    counts = np.zeros(2, dtype=np.int64)
+    samples = np.full((len(steps), len(seeds), 3), np.nan)
+    last = np.array(seeds, dtype=float)
+    status = np.zeros(len(seeds), dtype=int)
+    t = t_span[0]
+    for m, tm in enumerate(steps):
+        alive = np.flatnonzero(status == 0)
+        last[alive], status[alive] = advect_particles(intp, last[alive], t, tm, method=method, dt=abs(dt),
+                                                      scale=scale, rtol=1.0e-3, atol=1.0e-6, counts=counts)
+        samples[m, alive[status[alive] == 0]] = last[alive[status[alive] == 0]]
+        t = tm
+    profiler.count('solver_steps', int(counts[0]))
+    profiler.count('rejected_steps', int(counts[1]))
+    return samples, last, status
+
+def _resample_arclength(start, samples, t_start, steps, carry, ds):
+    # points at uniform arc length spacing ds along the piecewise linear 
+    # curves through start (n,3) and samples (M,n,3) (NaN after termination).
+    # carry: arc length since the last output point of each curve.
+    # Returns curve index, time and position of the new points (ordered by
+    # curve) and the updated carry
+    points = np.concatenate([start[None], samples])
+    times = np.concatenate([[t_start], steps])
+    m, n = points.shape[:2]
+    # positions after termination repeat the last valid one
+    valid = ~np.isnan(points[..., 0])
+    last = np.maximum.accumulate(np.where(valid, np.arange(m)[:, None], 0), axis=0)
+    points = points[last, np.arange(n)]
+    seg = np.linalg.norm(np.diff(points, axis=0), axis=-1)
+    length = np.concatenate([np.zeros((1, n)), np.cumsum(seg, axis=0)]).T
+    total = carry + length[:, -1]
+    count = np.floor(total / ds).astype(np.int64)
+    curve = np.repeat(np.arange(n), count)
+    k = np.arange(len(curve)) - np.repeat(np.cumsum(count) - count, count)
+    s = (k + 1)*ds - carry[curve]
+    # single search over all curves made globally increasing by offsets
+    offsets = np.concatenate([[0], np.cumsum(length[:, -1] + 1)[:-1]])
+    j = np.searchsorted((length + offsets[:, None]).ravel(), s + offsets[curve]) - curve*m
+    j = np.clip(j, 1, m-1)
+    l0 = length[curve, j-1]
+    dl = length[curve, j] - l0
+    w = np.where(dl > 0, (s - l0) / np.where(dl > 0, dl, 1), 0)[:, None]
+    p = (1-w)*points[j-1, curve] + w*points[j, curve]
+    t = (1-w[:, 0])*times[j-1] + w[:, 0]*times[j]
+    return curve, t, p, total - count*ds
+
+def _time_steps(times, t_init):
+    # integration direction and time steps from t_init on, in the order of
+    # times. Windows span depth consecutive entries
+    direction = 1 if times[-1] >= times[0] else -1
+    return direction, [ t_init ] + [ t for t in times if direction*(t - t_init) > 0 ]
+
+def _scheduler(intp, boundaries, windows, options):
+    # loads window k+1 while window k is integrated, unless disabled
+    if not options.get('overlap', True) or not windows:
+        return None
+    return WindowScheduler(intp, [ intp.window_steps(boundaries[a], boundaries[b]) for a, b in windows ])
+
+def _window_steps(intp, boundaries, windows, direction):
+    # time steps of each window, in the order of integration
+    steps = []
+    for a, b in windows:
+        lo, hi = intp.window_steps(boundaries[a], boundaries[b])
+        steps.append(list(range(lo, hi+1))[::direction])
+    return steps
+
+def _share_windows(publisher, boundaries, windows, steps, futures):
+    # owner side of shared workers: keeps the time steps of the window
+    # reached by the slowest worker, and of the next one, published until
+    # all workers are done. Workers report the first boundary of their
+    # current window (see _trace_seeds)
+    starts = [ a for a, _ in windows ]
+    while True:
+        reached = int(np.min(publisher.progress()))
+        if reached >= len(boundaries)-1:
+            k = len(windows)
+        else:
+            k = max(bisect.bisect_right(starts, reached)-1, 0)
+        wanted = [ step for window in steps[k:k+2] for step in window ]
+        publisher.release(publisher.published() - set(wanted))
+        publisher.publish(wanted)
+        done, _ = wait(futures, timeout=0.01)
+        if len(done) == len(futures):
+            return
+
+def _checkpoint_file(checkpoint, shard):
+    return os.path.join(checkpoint, f'shard_{shard:04d}.npz') if checkpoint is not None else None
+
+def _save_checkpoint(filename, state):
+    # written to a temporary file first so that an interruption never
+    # leaves a truncated checkpoint behind
+    tmp = filename + '.tmp.npz'
+    np.savez(tmp, **state)
+    os.replace(tmp, filename)
+
+def _trace_seeds(intp, seeds, times, options, offset=0, writer=None, checkpoint=None, profiler=NULL_PROFILER):
+    # (pathline id, time, position) chunks of the samples of the pathlines
+    # starting at seeds, ids starting at offset. Chunks are passed to writer
+    # as they are produced, or returned if no writer is given. With a
+    # checkpoint file, the state is saved after each time window and, if
+    # options['resume'] is set, restored from it. Timings and counters are
+    # added to profiler, also attached to intp
+    intp.profiler = profiler
+    # resident time steps, set by the byte budget when there is one
+    depth = intp.stack
+    scale = options['scale']
+    t_init = options['t_init']
+    integrator = options['integrator']
+    method = options['method']
+    verbose = options['verbose']
+    sampling = options['sampling']
+    nsamples = options['nsamples']
+
+    # determine bounds 
+    bounds = intp.data.GetBounds()
+    event = OutOfBoundsEvent(bounds)
+    ds = options['ds']
+    if sampling == 'arclength' and ds is None:
+        ds = 0.01*np.linalg.norm(np.array(bounds[1::2]) - np.array(bounds[0::2]))
+
+    direction, boundaries = _time_steps(times, t_init)
+    
+    nseeds = seeds.shape[0]
+    chunks = []
+    if writer is not None:
+        sink = writer.append
+    else:
+        sink = lambda *chunk: chunks.append(chunk)
+
+    if checkpoint is not None and options['resume'] and os.path.exists(checkpoint):
+        state = np.load(checkpoint)
+        if int(state['nseeds']) != nseeds or int(state['offset']) != offset:
+            raise ValueError(f'Checkpoint {checkpoint} does not match seeds {offset}-{offset+nseeds-1}')
+        next = int(state['window'])
+        positions = state['positions']
+        stopped = state['stopped']
+        carry = state['carry']
+        if writer is not None:
+            writer.chunks = json.loads(str(state['chunks']))
+        elif len(state['ids']):
+            chunks.append((state['ids'], state['times'], state['points']))
+        if len(state['cached']) and not options.get('overlap', True):
+            intp.load([ int(i) for i in state['cached'] ], 'full')
+        if verbose: print(f'resuming seeds {offset}-{offset+nseeds-1} at time {boundaries[next]}')
+    else:
+        next = 0
+        positions = seeds.copy()
+        stopped = np.zeros(nseeds, dtype=bool)
+        carry = np.zeros(nseeds)
+        sink(np.arange(nseeds) + offset, np.full(nseeds, float(t_init)), seeds)
+
+    # last cell of each particle, carried across windows
+    cells = intp.cell_hints(nseeds)
+    windows = split_windows(boundaries, depth, next)
+    scheduler = _scheduler(intp, boundaries, windows, options)
+    for k, (cur, next) in enumerate(windows):
+        if np.all(stopped):
+            break
+        if intp.shared is not None:
+            intp.shared.report(cur)
+        if scheduler is not None:
+            scheduler.activate(k)
+        t_span = (boundaries[cur], boundaries[next])
+        dt = (t_span[1] - t_span[0])/100
+        steps = t_span[0] + (t_span[1] - t_span[0])/nsamples*np.arange(1, nsamples+1)
+        if sampling == 'steps':
+            steps = steps[:0]
+        alive = np.flatnonzero(~stopped)
+        start = positions[alive]
+        hints = cells[alive] if cells is not None else None
+        with profiler.phase('integrate'):
+            if integrator == 'ensemble':
+                res = integrate_ensemble(_velocity(intp, scale), t_span, start, method=method, 
+                                         t_eval=steps, first_step=dt, max_step=20*abs(dt), 
+                                         rtol=1.0e-3, atol=1.0e-6, record_steps=sampling=='steps', hints=hints)
+                samples, last, status, solver_steps = res.y_eval, res.y, res.status, res.steps
+            elif integrator == 'kernel':
+                samples, last, status = _trace_kernel(intp, scale, t_span, start, steps, method, dt, profiler)
+            else:
+                samples, last, status, solver_steps = _trace_scipy(intp, scale, event, t_span, start, steps, 
+                                                                   method, dt, sampling=='steps', profiler)
+        if integrator == 'ensemble':
+            profiler.count('solver_steps', res.naccepted)
+            profiler.count('rejected_steps', res.nrejected)
+        profiler.count('windows')
+        positions[alive] = last
+        if cells is not None:
+            cells[alive] = hints
+        stopped[alive[status != 0]] = True
+        if verbose: 
+            for i in alive[status != 0]: print(f'pathline #{offset+i} has ended')
+
+        with profiler.phase('output'):
+            if sampling == 'time':
+                # particle-major order keeps samples of each pathline chronological
+                samples = samples.transpose(1, 0, 2)
+                valid = ~np.isnan(samples[..., 0])
+                rows, cols = np.nonzero(valid)
+                sink(alive[rows] + offset, steps[cols], samples[valid])
+            elif sampling == 'steps':
+                rows, t, p = solver_steps
+                sink(alive[rows] + offset, t, p)
+            else:
+                rows, t, p, carry[alive] = _resample_arclength(start, samples, t_span[0], steps, carry[alive], ds)
+                sink(alive[rows] + offset, t, p)
+
+        if checkpoint is not None:
+            state = { 'window': next, 'nseeds': nseeds, 'offset': offset,
+                      'positions': positions, 'stopped': stopped, 'carry': carry,
+                      'cached': np.array(intp.cached_time_steps, dtype=np.int64) }
+            if writer is not None:
+                state['chunks'] = json.dumps(writer.chunks)
+            else:
+                state['ids'] = np.concatenate([ c[0] for c in chunks ])
+                state['times'] = np.concatenate([ c[1] for c in chunks ])
+                state['points'] = np.concatenate([ c[2] for c in chunks ])
+                # one array per kind rather than one per window
+                chunks[:] = [ (state['ids'], state['times'], state['points']) ]
+            with profiler.phase('checkpoint'):
+                _save_checkpoint(checkpoint, state)
+
+    if scheduler is not None:
+        scheduler.close()
+    if intp.cache is not None:
+        profiler.count('cache_hits', intp.cache.hits)
+        profiler.count('cache_misses', intp.cache.misses)
+    locator = intp.locator_stats()
+    if locator is not None:
+        for name, n in locator.items():
+            profiler.count(f'locator_{name}', n)
+    return chunks
+
+def _trace_worker(job):
+    # worker process: own TimeInterpolator, or one attached to the shared
+    # time steps published by the parent process. With an output directory,
+    # chunks are written as part shard and their descriptions returned,
+    # together with the worker's profiling statistics if enabled
+    shard, offset, seeds, times, filenames, value_name, options, handle, output, checkpoint = job
+    profiler = Profiler() if options['profile'] else NULL_PROFILER
+    if handle is not None:
+        # steps come from shared memory: no cache of their own
+        intp = TimeInterpolator.from_shared(handle, worker=shard, stack=options['depth'], walk=options['walk'])
+    else:
+        intp = TimeInterpolator(times, filenames, attributes=[value_name], stack=options['depth'],
+                                cache_bytes=options['cache_bytes'], walk=options['walk'])
+    try:
+        checkpoint = _checkpoint_file(checkpoint, shard)
+        if output is None:
+            chunks = _trace_seeds(intp, seeds, times, options, offset, checkpoint=checkpoint, profiler=profiler)
+        else:
+            writer = PathlineWriter(output, part=shard)
+            _trace_seeds(intp, seeds, times, options, offset, writer, checkpoint, profiler)
+            chunks = writer.chunks
+        return chunks, profiler.to_dict() if profiler.enabled else None
+    finally:
+        if intp.shared is not None:
+            intp.shared.report(None)
+        intp.close()
+
+def _report(profiler, profile):
+    profiler.stop()
+    if profile is True:
+        print(profiler.table())
+
+def trace_pathlines(seeds, times, filenames, value_name, **kwargs):
+    integrator = kwargs.get('integrator', 'ensemble')
+    options = { 'depth': kwargs.get('depth', 3),
+                'scale': kwargs.get('scale', 1.0),
+                't_init': kwargs.get('t_init', times[0]),
+                'verbose': kwargs.get('verbose', False),
+                # 'ensemble': all seeds advanced together (see integrate_ensemble)
+                # 'scipy': one solve_ivp call per seed and per window
+                # 'kernel': compiled uniform grid kernels (see kernels.py),
+                # with method 'RK4' (fixed step) or 'RK45'
+                'integrator': integrator,
+                'method': kwargs.get('method', 'RK4' if integrator == 'kernel' else 'DOP853'),
+                'resume': kwargs.get('resume', False),
+                # read the time steps of the next window in the background
+                # while the current one is integrated (see WindowScheduler)
+                'overlap': kwargs.get('overlap', True),
+                # hinted point location in tetrahedral meshes (see Interpolator)
+                'walk': kwargs.get('walk', False),
+                # memory budget of the time steps, in bytes. When given, it
+                # sets depth and bounds the steps read ahead (see TimeInterpolator)
+                'cache_bytes': kwargs.get('cache_bytes', None),
+                # output sampling: 'time' (nsamples per window, uniform in time),
+                # 'arclength' (uniform spacing ds along curves, 1% of domain 
+                # diagonal by default) or 'steps' (solver steps only)
+                'sampling': kwargs.get('sampling', 'time'),
+                'nsamples': kwargs.get('nsamples', 100),
+                'ds': kwargs.get('ds', None) }
+    # number of worker processes among which seeds are split. With shared,
+    # time steps are loaded once in shared memory instead of by each worker
+    workers = kwargs.get('workers', 1)
+    shared = kwargs.get('shared', False)
+    # optional directory where samples are streamed window by window
+    # (see PathlineWriter). A PathlineStore is then returned instead of
+    # in-memory arrays
+    output = kwargs.get('output', None)
+    # return a CurveSet (with a 'time' attribute) instead of arrays and lists
+    as_curves = kwargs.get('as_curves', False)
+    # optional directory where the state of the integration is saved after
+    # each time window. With resume=True, a previous run using the same
+    # seeds and number of workers continues from its last checkpoint
+    checkpoint = kwargs.get('checkpoint', None)
+    if checkpoint is not None:
+        os.makedirs(checkpoint, exist_ok=True)
+    # instrumentation: a Profiler (see vtk_profiling) that receives timings
+    # of reads, cell location, interpolation, integration and output, and
+    # solver, RHS and cache counters, or True to print them as a table.
+    # Disabled by default, at no cost
+    profile = kwargs.get('profile', None)
+    profiler = profile if isinstance(profile, Profiler) else (Profiler() if profile else NULL_PROFILER)
+    options['profile'] = profiler.enabled
+    verbose = options['verbose']
     
     nsteps = len(filenames)
     if nsteps == 0:
         raise RuntimeError('No files in input')
     elif nsteps == 1:
         raise RuntimeError('Only a single time step available')
+    if options['integrator'] not in ['ensemble', 'scipy', 'kernel']:
+        raise ValueError(f'Unknown integrator {options["integrator"]}')
+    if options['integrator'] == 'kernel' and options['sampling'] == 'steps':
+        raise ValueError('Kernel integrator does not support steps sampling')
+    if options['sampling'] not in ['time', 'arclength', 'steps']:
+        raise ValueError(f'Unknown sampling {options["sampling"]}')
     
-    intp = None
+    seeds = np.array(seeds, dtype=float).reshape(-1, 3)
+    nseeds = seeds.shape[0]
 
-    # determine bounds 
-    reader = read_vtk_file(filenames[0])
-    reader.Update()
-    bounds = reader.GetOutput().GetBounds()
-    event = OutOfBoundsEvent(bounds)
-    
-    pathlines = [ [seed] ]
-    ptimes = [ [t_init] ]
-
-    next = 0
-    stopped  = np.zeros(len(pathlines))
-    while next < len(times)-1:
-        cur = next
-        next = min(cur+depth-1, len(times)-1)
-        times = times[cur:next+1]
-        dt = (times[-1] - times[0])/100
-        bwd = dt < 0
-        names = filenames[cur:next+1]
-        if intp is None:
-            intp = TimeInterpolator(times, names, attributes=[value_name], scale=scale)
-        else:
-            intp.update_data(times, names)
-        for i, pathline in tqdm(enumerate(pathlines)):
-            if stopped[i]:
+    writer = PathlineWriter(output) if output is not None else None
+    if workers is None or workers <= 1 or nseeds < 2:
+        with profiler.phase('setup'):
+            intp = TimeInterpolator(times, filenames, attributes=[value_name], stack=options['depth'],
+                                    cache_bytes=options['cache_bytes'], walk=options['walk'])
+        chunks = _trace_seeds(intp, seeds, times, options, writer=writer, checkpoint=_checkpoint_file(checkpoint, 0),
+                              profiler=profiler)
+    else:
+        # contiguous shards, merged back in seed order
+        shards = [ shard for shard in np.array_split(np.arange(nseeds), workers) if len(shard) ]
+        publisher = None
+        handle = None
+        if shared:
+            # only the window in use by the workers and the next one are
+            # published at any time, and each step is read once
+            publisher = SharedTimeSeries(TimeInterpolator(times, filenames, attributes=[value_name]), 
+                                         workers=len(shards))
+            if options['cache_bytes']:
+                # the budget covers the published windows
+                options['depth'] = publisher.intp.steps_in_budget(options['cache_bytes'])
+            direction, boundaries = _time_steps(times, options['t_init'])
+            windows = split_windows(boundaries, options['depth'])
+            steps = _window_steps(publisher.intp, boundaries, windows, direction)
+            publisher.schedule([ step for window in steps for step in window ])
+            publisher.publish(steps[0])
+            handle = publisher.handle()
+        jobs = [ (k, int(shard[0]), seeds[shard], times, filenames, value_name, options, handle, output, checkpoint)
+                 for k, shard in enumerate(shards) ]
+        try:
+            with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+                futures = [ executor.submit(_trace_worker, job) for job in jobs ]
+                if publisher is not None:
+                    _share_windows(publisher, boundaries, windows, steps, futures)
+                results = [ future.result() for future in futures ]
+        finally:
+            if publisher is not None:
+                publisher.close()
+        chunks = [ chunk for result, _ in results for chunk in result ]
+        for _, stats in results:
+            if stats is not None:
+                profiler.merge(stats)
+
+    if writer is not None:
+        if workers is not None and workers > 1 and nseeds >= 2:
+            writer.chunks = chunks
+        with profiler.phase('assemble'):
+            store = writer.close(nseeds)
+        if verbose: print(f'{store.npoints} points of {nseeds} pathlines written to {output}')
+        _report(profiler, profile)
+        return store
+
+    with profiler.phase('assemble'):
+        ids = np.concatenate([ c[0] for c in chunks ])
+        all_times = np.concatenate([ c[1] for c in chunks ])
+        all_pts = np.concatenate([ c[2] for c in chunks ])
+        order = np.argsort(ids, kind='stable')
+        all_pts = all_pts[order]
+        all_times = all_times[order]
+        counts = np.bincount(ids, minlength=nseeds)
+        curves = CurveSet.from_arrays(all_pts, np.concatenate([[0], np.cumsum(counts)]), time=all_times)
+
+    if verbose: print(f'npts={curves.npoints}, len(pathlines)={nseeds}')
+    _report(profiler, profile)
+
+    if as_curves:
+        return curves
+    return all_pts, all_times, curves.offsets.tolist(), curves.line_ids()
+
+def _trace_releases(intp, seeds, times, release_times, options, record):
+    # advects particles released from seeds at release_times together, one
+    # time window at a time, so that each time step is loaded once. Windows
+    # are split at release times that fall inside them. record(t, positions,
+    # released) is called at the end of each window with positions
+    # (nreleases, nseeds, 3), NaN for particles not released yet or lost.
+    # release_times must be ordered in the direction of integration
+    depth = options['depth']
+    scale = options['scale']
+    method = options['method']
+    verbose = options['verbose']
+    direction, boundaries = _time_steps(times, options['t_init'])
+    releases = release_times
+    nseeds = seeds.shape[0]
+    positions = np.full((len(releases), nseeds, 3), np.nan)
+    alive = np.zeros((len(releases), nseeds), dtype=bool)
+    flat = positions.reshape(-1, 3)
+    cells = intp.cell_hints(flat.shape[0])
+    released = 0
+
+    def release(t):
+        nonlocal released
+        while released < len(releases) and direction*(releases[released] - t) <= 0:
+            positions[released] = seeds
+            alive[released] = True
+            released += 1
+
+    windows = split_windows(boundaries, depth)
+    scheduler = _scheduler(intp, boundaries, windows, options)
+    for k, (cur, next) in enumerate(windows):
+        if scheduler is not None:
+            scheduler.activate(k)
+        ta, tb = boundaries[cur], boundaries[next]
+        dt = (tb - ta)/100
+        inner = [ t for t in releases if direction*(t - ta) > 0 and direction*(tb - t) > 0 ]
+        stops = [ ta ] + sorted(set(inner), key=lambda t: direction*t) + [ tb ]
+        for sa, sb in zip(stops[:-1], stops[1:]):
+            release(sa)
+            ids = np.flatnonzero(alive)
+            if len(ids) == 0:
                 continue
-        
-            aseed = pathline[-1]
-            try:
-                res = sp.integrate.solve_ivp(
-                    intp, t_span=(times[0], times[-1]), y0=aseed, method='DOP853', 
-                    dense_output=True, events=event, first_step=dt, max_step=20*dt,
-                    rtol=1.0e-3, atol=1.0e-6)
-                if bwd:
-                    steps = np.arange(res.sol.t_max, res.sol.t_min, dt)
-                else:
-                    steps = np.arange(res.sol.t_min, res.sol.t_max, dt)
-                for t in steps[1:]:
-                    pathlines[i].append(res.sol(t))
-                    ptimes[i].append(t)
-                if (bwd and res.sol.t_min > times[-1]) or (not bwd and res.sol.t_max < times[-1]):
-                    stopped[i] = 1
-                    if bwd:
-                        t_stop = res.sol.t_min
-                    else:
-                        t_stop = res.sol.t_max
-                    if verbose: print(f'pathlines #{i} has ended at time {t_stop}')
-            except:
-                stopped[i] = 1
-                if verbose: print(f'pathline #{i} has ended')
-        
-        for i, p in enumerate(pathlines):
-            if verbose: print(f'pathline #{i} contains {len(p)} points')
-
-    strides = [0]
-    npts = 0
-
-    all_pts = []
-    all_times = []
-    for p,t  in zip(pathlines, ptimes):
-        strides.append(len(p) + strides[-1])
-        npts += len(p)
-        all_pts.extend(p)
-        all_times.extend(t)
-
-    if verbose: print(f'npts={npts}, strides={strides}, len(pathlines)={len(pathlines)}, number={args.number}')
-
-    line_ids = [ list(range(strides[i], strides[i+1])) for i in range(len(seeds)) ]
-    return all_pts, all_times, strides, line_ids
+            hints = cells[ids] if cells is not None else None
+            res = integrate_ensemble(_velocity(intp, scale), (sa, sb), flat[ids], method=method,
+                                     first_step=min(abs(dt), abs(sb - sa)), max_step=20*abs(dt),
+                                     rtol=1.0e-3, atol=1.0e-6, hints=hints)
+            flat[ids] = res.y
+            if cells is not None:
+                cells[ids] = hints
+            lost = ids[res.status != 0]
+            flat[lost] = np.nan
+            alive.flat[lost] = False
+        release(tb)
+        if verbose: print(f'time {tb}: {released} releases, {np.count_nonzero(alive)} particles')
+        record(tb, positions, released)
+    if scheduler is not None:
+        scheduler.close()
+
+def _release_curves(positions, released, releases, by_seed):
+    # streaklines (one curve per seed, from the newest particle to the
+    # oldest) or timelines (one curve per release, in seed order) through
+    # the particles still in the domain. Curves of lost particles skip them
+    positions = positions[:released]
+    times = np.broadcast_to(releases[:released, None], positions.shape[:2])
+    if by_seed:
+        positions = positions[::-1].transpose(1, 0, 2)
+        times = times[::-1].T
+    valid = ~np.isnan(positions[..., 0])
+    curves = CurveSet()
+    curves.add_curves(positions[valid], np.count_nonzero(valid, axis=1), release_time=times[valid])
+    return curves
+
+def _trace_release_curves(seeds, times, filenames, value_name, by_seed, kwargs):
+    options = { 'depth': kwargs.get('depth', 3),
+                'scale': kwargs.get('scale', 1.0),
+                't_init': kwargs.get('t_init', times[0]),
+                'verbose': kwargs.get('verbose', False),
+                'method': kwargs.get('method', 'DOP853'),
+                'overlap': kwargs.get('overlap', True),
+                'walk': kwargs.get('walk', False) }
+    if len(filenames) < 2:
+        raise RuntimeError('At least two time steps are needed')
+    seeds = np.array(seeds, dtype=float).reshape(-1, 3)
+    # particles are released at every time step by default
+    release_times = kwargs.get('release_times', None)
+    if release_times is None:
+        release_times = _time_steps(times, options['t_init'])[1]
+    # with snapshots, curves are also returned at the end of every window
+    snapshots = kwargs.get('snapshots', False)
+    direction = _time_steps(times, options['t_init'])[0]
+    releases = np.array(release_times, dtype=float)
+    releases = releases[np.argsort(direction*releases, kind='stable')]
+    intp = TimeInterpolator(times, filenames, attributes=[value_name], stack=options['depth'], walk=options['walk'])
+    frames = []
+    def record(t, positions, released):
+        if snapshots:
+            frames.append((t, _release_curves(positions, released, releases, by_seed)))
+        else:
+            frames[:] = [ (t, positions, released) ]
+    _trace_releases(intp, seeds, times, releases, options, record)
+    intp.close()
+    if snapshots:
+        return frames
+    _, positions, released = frames[-1]
+    return _release_curves(positions, released, releases, by_seed)
+
+def trace_streaklines(seeds, times, filenames, value_name, **kwargs):
+    ''' Streaklines of seeds at the final time: CurveSet with one curve per
+        seed through the particles released from it at release_times (every
+        time step by default), with a 'release_time' attribute. Accepts the
+        depth, scale, t_init, method and verbose options of trace_pathlines.
+        With snapshots=True, a list of (time, CurveSet) at the end of every
+        time window is returned instead '''
+    return _trace_release_curves(seeds, times, filenames, value_name, True, kwargs)
+
+def trace_timelines(seeds, times, filenames, value_name, **kwargs):
+    ''' Timelines of the curve through seeds at the final time: CurveSet
+        with one curve per release time (every time step by default), with
+        points in seed order and a 'release_time' attribute. Same options as
+        trace_streaklines '''
+    return _trace_release_curves(seeds, times, filenames, value_name, False, kwargs)
 
 
 if __name__ == '__main__':
@@ -135,9 +632,28 @@ if __name__ == '__main__':
     parser.add_argument('-x', '--scale', type=float, default=1, help='Scaling factor for velocity values')
     parser.add_argument('--delta_t', type=float, help='Time interval between timesteps (if uniform)')
     parser.add_argument('--t_init', type=float, default=0, help='Time coordinate of first time step')
+    parser.add_argument('--integrator', type=str, default='ensemble', choices=['ensemble', 'scipy', 'kernel'], help='Batched ensemble integration, one solve_ivp per seed or compiled kernels')
+    parser.add_argument('--method', type=str, choices=['RK4', 'RK45', 'DOP853'], help='Runge-Kutta scheme (default: DOP853, RK4 with kernel integrator)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--shared', action='store_true', help='Share loaded time steps among worker processes')
+    parser.add_argument('-o', '--output', type=str, help='Directory where pathlines are streamed during integration')
+    parser.add_argument('--checkpoint', type=str, help='Directory where the integration state is saved after each time window')
+    parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint')
+    parser.add_argument('--sampling', type=str, default='time', choices=['time', 'arclength', 'steps'], help='Output sampling of pathlines')
+    parser.add_argument('--nsamples', type=int, default=100, help='Number of samples per time window (time sampling)')
+    parser.add_argument('--ds', type=float, help='Distance between samples (arclength sampling)')
+    parser.add_argument('--cache_bytes', type=float, help='Memory budget of the time steps in bytes (sets --size)')
+    parser.add_argument('--walk', action='store_true', help='Locate points by walking from the previous cell (tetrahedral meshes)')
+    parser.add_argument('--no_overlap', action='store_true', help='Do not read the next time window during integration')
+    parser.add_argument('--kind', type=str, default='pathlines', choices=['pathlines', 'streaklines', 'timelines'], help='Type of integral curves (timelines are seeded along the domain diagonal)')
+    parser.add_argument('--profile', type=str, nargs='?', const='', help='Print timings and counters of each phase (and save them to the given JSON file)')
+    parser.add_argument('--verbose', action='store_true', help='Print progress information')
     args = parser.parse_args()
 
 
+    if args.method is None:
+        args.method = 'RK4' if args.integrator == 'kernel' else 'DOP853'
+
     filenames = find_files(args.path, args.filenames)
     print('filenames are now:\n', filenames)
 
@@ -166,27 +682,46 @@ if __name__ == '__main__':
     lower = np.array([bounds[0], bounds[2], bounds[4]])
     upper = np.array([bounds[1], bounds[3], bounds[5]])
 
-    seed(0) # for reproducibility
+    random.seed(0) # for reproducibility
 
     seeds = []
     t0 = args.times[0]
     for i in range(args.number):
-        q = np.array([random(), random(), random()])
+        q = np.array([random.random(), random.random(), random.random()])
         p = (np.ones(3) - q)*lower + q*upper
         seeds.append(p)
 
-    all_steps, all_times, strides, line_ids = \
-        trace_pathlines(seeds, args.times, filenames, 
-                        args.value_name, depth=args.size, 
-                        scale=args.scale, t_init=t0, 
-                        verbose=args.verbose)
+    profiler = Profiler() if args.profile is not None else None
+    if args.kind == 'pathlines':
+        result = trace_pathlines(seeds, args.times, filenames, 
+                                 args.value_name, depth=args.size, 
+                                 scale=args.scale, t_init=t0, 
+                                 integrator=args.integrator, method=args.method,
+                                 workers=args.workers, shared=args.shared,
+                                 sampling=args.sampling, nsamples=args.nsamples, ds=args.ds,
+                                 output=args.output, checkpoint=args.checkpoint, resume=args.resume,
+                                 overlap=not args.no_overlap, walk=args.walk, profile=profiler,
+                                 cache_bytes=args.cache_bytes,
+                                 as_curves=True, verbose=args.verbose)
+        curves = result.to_curves() if args.output is not None else result
+        name = 'time'
+        if profiler is not None:
+            print(profiler.table())
+            if args.profile:
+                profiler.to_json(args.profile)
+    else:
+        if args.kind == 'timelines':
+            seeds = [ (1-u)*lower + u*upper for u in np.linspace(0, 1, args.number) ]
+        trace = trace_streaklines if args.kind == 'streaklines' else trace_timelines
+        curves = trace(seeds, args.times, filenames, args.value_name, depth=args.size,
+                       scale=args.scale, t_init=t0, method=args.method, 
+                       overlap=not args.no_overlap, walk=args.walk, verbose=args.verbose)
+        name = 'release_time'
 
-    poly = make_points(all_steps)
-    poly = add_scalars(poly, all_times)
-    poly = add_polylines(poly, line_ids)
+    poly = curves.to_polydata(scalars=name)
 
-    min_t = np.min(all_times)
-    max_t = np.max(all_times)
+    min_t = np.min(curves.attribute(name))
+    max_t = np.max(curves.attribute(name))
     ctf = make_colormap('viridis', [min_t, max_t])
     actor = make_actor(poly, ctf=ctf)
     renderer, window, interactor = make_render_kit(actors=[actor])
@@ -6,6 +6,9 @@ __all__ = [
     "vtk_dataset",
     "vtk_io",
     "vtk_interpolation",
+    "vtk_timeseries",
+    "vtk_bricks",
+    "vtk_profiling",
     "vtk_rendering",
     "vtk_qt",
 ]
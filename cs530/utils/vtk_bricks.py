@@ -0,0 +1,179 @@
+import os
+import json
+import argparse
+import numpy as np
+import vtk
+
+from cs530.utils.vtk_helper import storage_dtype
+from cs530.utils.vtk_interpolation import _Utils, _UniformGrid, _ArrayCache
+
+'''
+Out-of-core storage and interpolation of uniform volumes that do not fit
+in memory. The volume is split into bricks of brick_size^3 cells stored on
+disk. Each brick also holds the samples on its upper faces (ghost layer),
+so trilinear interpolation in any of its cells never needs a neighbouring
+brick. Bricks are paged in on demand through a byte-budgeted LRU.
+'''
+
+__all__ = [
+    'BrickedVolume',
+    'BrickedInterpolator',
+]
+
+_MANIFEST = 'manifest.json'
+
+def _brick_filename(key):
+    return f'brick_{key[0]}_{key[1]}_{key[2]}.npy'
+
+class BrickedVolume:
+    @staticmethod
+    def create(path, source, brick_size=64, attribute='scalars', origin=None, spacing=None, 
+               dtype=None, verbose=False):
+        ''' Split source into bricks stored in directory path. source is a
+            (nz, ny, nx[, ncomp]) array (np.memmap for volumes larger than
+            memory), a vtkImageData or the name of a file readable by
+            _Utils._import_dataset (raw NRRD files are memory-mapped).
+            dtype: storage precision of the bricks (see vtk_helper.set_precision) '''
+        if isinstance(source, str):
+            source = _Utils._import_dataset(source)
+        if isinstance(source, vtk.vtkImageData):
+            if not _UniformGrid.supports(source):
+                raise ValueError('Only axis-aligned image data can be bricked')
+            dims = source.GetDimensions()
+            origin = source.GetOrigin()
+            spacing = source.GetSpacing()
+            values = _Utils._as_numpy(_Utils._get_attribute(source, attribute))
+            data = values.reshape((dims[2], dims[1], dims[0], -1))
+        else:
+            data = source if source.ndim == 4 else source[..., np.newaxis]
+            dims = (data.shape[2], data.shape[1], data.shape[0])
+        dtype = storage_dtype(dtype, default=data.dtype)
+        origin = np.zeros(3) if origin is None else np.asarray(origin, dtype=float)
+        spacing = np.ones(3) if spacing is None else np.asarray(spacing, dtype=float)
+
+        os.makedirs(path, exist_ok=True)
+        ncells = np.maximum(np.array(dims)-1, 1)
+        nbricks = -(-ncells // brick_size)
+        for bk in range(nbricks[2]):
+            for bj in range(nbricks[1]):
+                for bi in range(nbricks[0]):
+                    lo = np.array([bi, bj, bk])*brick_size
+                    hi = np.minimum(lo+brick_size+1, dims)
+                    brick = data[lo[2]:hi[2], lo[1]:hi[1], lo[0]:hi[0]]
+                    np.save(os.path.join(path, _brick_filename((bi, bj, bk))), np.ascontiguousarray(brick, dtype=dtype))
+            if verbose: print(f'bricked slab {bk+1}/{nbricks[2]}')
+        manifest = { 'dimensions': [ int(d) for d in dims ],
+                     'origin': origin.tolist(),
+                     'spacing': spacing.tolist(),
+                     'brick_size': int(brick_size),
+                     'ncomponents': int(data.shape[3]),
+                     'dtype': dtype.str }
+        with open(os.path.join(path, _MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return BrickedVolume(path)
+
+    def __init__(self, path, max_bytes=1<<30):
+        self.path = path
+        with open(os.path.join(path, _MANIFEST)) as f:
+            manifest = json.load(f)
+        self.dims = np.array(manifest['dimensions'])
+        self.origin = np.array(manifest['origin'])
+        self.spacing = np.array(manifest['spacing'])
+        self.brick_size = manifest['brick_size']
+        self.ncomponents = manifest['ncomponents']
+        self.dtype = np.dtype(manifest['dtype'])
+        self.cache = _ArrayCache(self.read_brick, max_bytes)
+
+    def geometry(self):
+        # vtkImageData without point data describing the volume
+        image = vtk.vtkImageData()
+        image.SetDimensions(self.dims.tolist())
+        image.SetOrigin(self.origin)
+        image.SetSpacing(self.spacing)
+        return image
+
+    def bounds(self):
+        upper = self.origin + (self.dims-1)*self.spacing
+        return [ self.origin[0], upper[0], self.origin[1], upper[1], self.origin[2], upper[2] ]
+
+    def read_brick(self, key):
+        return np.load(os.path.join(self.path, _brick_filename(key)))
+
+    def brick(self, key):
+        return self.cache.get(tuple(int(k) for k in key))
+
+    @property
+    def nbytes(self):
+        # bytes currently resident in memory
+        return self.cache.nbytes
+
+    def close(self):
+        self.cache.close()
+
+class BrickedInterpolator:
+    ''' Interpolator over a BrickedVolume with the interface of
+        Interpolator. Queries are grouped by brick and each brick is
+        paged in once per batch. '''
+    def __init__(self, volume, raise_oob_error=False):
+        if isinstance(volume, str):
+            volume = BrickedVolume(volume)
+        self.volume = volume
+        self.oob_error = raise_oob_error
+        self.data = volume.geometry()
+        self.grid = _UniformGrid(self.data)
+
+    @property
+    def nbytes(self):
+        return self.volume.nbytes
+
+    def _values(self, cell, weights, oob):
+        size = self.volume.brick_size
+        values = np.full((len(cell), self.volume.ncomponents), np.nan)
+        # out-of-bounds rows touch no brick
+        inside = np.flatnonzero(~oob)
+        keys = cell[inside] // size
+        # one pass per brick touched by the batch
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        for n, key in enumerate(unique):
+            sel = inside[inverse.reshape(-1) == n]
+            brick = self.volume.brick(key)
+            shape = np.array(brick.shape[2::-1])
+            strides = np.array([1, shape[0], shape[0]*shape[1]], dtype=np.int64)
+            offsets = (_UniformGrid.bits & (shape > 1)).astype(np.int64) @ strides
+            ids = ((cell[sel]-key*size) @ strides)[:,None] + offsets
+            values[sel] = _Utils._gather(brick.reshape(-1, self.volume.ncomponents), ids, weights[sel])
+        return values
+
+    def interpolate_many(self, points):
+        # same conventions as Interpolator.interpolate_many
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        cell, weights, oob = self.grid.cells_and_weights(points)
+        if self.oob_error and np.any(oob):
+            raise ValueError(f'{np.count_nonzero(oob)} positions are not in dataset domain')
+        values = self._values(cell, weights, oob)
+        if self.volume.ncomponents == 1:
+            values = values[:,0]
+        return values, oob
+
+    def interpolate(self, p):
+        values, oob = self.interpolate_many(p)
+        if oob[0]:
+            if self.oob_error:
+                raise ValueError(f'Position {p} is not in dataset domain')
+            return None
+        return _Utils._singleton_as_scalar(values[0]) if values.ndim > 1 else values[0]
+
+    def __call__(self, t, p):
+        return self.interpolate(p)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split a volume into bricks for out-of-core interpolation')
+    parser.add_argument('-i', '--input', type=str, required=True, help='Input volume (.vti, .nrrd, ...)')
+    parser.add_argument('-a', '--attribute', type=str, default='scalars', help='Name of the field to store')
+    parser.add_argument('-b', '--brick_size', type=int, default=64, help='Number of cells per brick along each axis')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Output directory')
+    parser.add_argument('--float32', action='store_true', help='Store values in single precision')
+    args = parser.parse_args()
+
+    BrickedVolume.create(args.output, args.input, args.brick_size, args.attribute, 
+                         dtype=np.float32 if args.float32 else None, verbose=True)
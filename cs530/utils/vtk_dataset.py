@@ -2,6 +2,8 @@ import vtk
 import numpy as np
 from vtk.util.numpy_support import numpy_to_vtk
 
+from cs530.utils.vtk_helper import storage_dtype
+
 __all__ = [
     'make_vtkpoints', 
     'make_points', 
@@ -38,8 +40,8 @@ def make3d(p):
         return [p[0], 0., 0.]
 
 ''' Create vtkPoints out of a bunch of coordinates '''
-def make_vtkpoints(positions):
-    coords = np.ndarray((length(positions), 3), dtype=float)
+def make_vtkpoints(positions, dtype=None):
+    coords = np.ndarray((length(positions), 3), dtype=storage_dtype(dtype))
     for i, p in enumerate(positions):
         coords[i] = make3d(p)
     pts = vtk.vtkPoints()
@@ -126,8 +128,8 @@ def add_colors(inout, colors, point_data=True, name="anonymous_colors",
 ''' Add vector attributes to point/cell data. vectors is an array-like
     container of 1D arrays'''
 def add_vectors(inout, vectors, point_data=True, name="anonymous_vectors",
-                active=True):
-    values = np.ndarray((len(vectors), 3), dtype=float)
+                active=True, dtype=None):
+    values = np.ndarray((len(vectors), 3), dtype=storage_dtype(dtype))
     for i, v in enumerate(vectors):
         values[i] = make3d(v)
     values = numpy_to_vtk(values)
@@ -147,9 +149,9 @@ def add_vectors(inout, vectors, point_data=True, name="anonymous_vectors",
 ''' Add tensor attributes to point/cell data. "tensors" is an array-like
     container of 1D arrays.'''
 def add_tensors(inout, tensors, point_data=True, name="anonymous_tensors",
-                active=True):
+                active=True, dtype=None):
     size = length(tensors[0])
-    values = np.ndarray((len(tensors), 9), dtype=float)
+    values = np.ndarray((len(tensors), 9), dtype=storage_dtype(dtype))
     if size==3:
         # symmetric 2d tensor
         for i, t in enumerate(tensors):
@@ -1,5 +1,6 @@
 import vtk
 import os
+import numpy as np
 
 '''
    Useful functions when working with VTK
@@ -9,8 +10,33 @@ __all__ = [
     'connect',
     'correct_reader',
     'correct_writer',
+    'set_precision',
+    'get_precision',
 ]
 
+# storage precision of field values (None: float64 for new arrays, 
+# native type for fields read from files). Computations are carried out
+# in float64 regardless of storage precision
+_precision = None
+
+def set_precision(dtype):
+    global _precision
+    precision = None if dtype is None else np.dtype(dtype)
+    if precision is not None and precision.kind != 'f':
+        raise ValueError(f'Invalid storage precision {dtype}')
+    _precision = precision
+
+def get_precision():
+    return _precision
+
+def storage_dtype(dtype=None, default=np.float64):
+    # dtype selected by the caller, else the global policy, else default
+    if dtype is not None:
+        return np.dtype(dtype)
+    if _precision is not None:
+        return _precision
+    return None if default is None else np.dtype(default)
+
 def is_algorithm(object):
     return isinstance(object, vtk.vtkAlgorithm)
 
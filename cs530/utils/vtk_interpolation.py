@@ -8,13 +8,35 @@ import os
 import nrrd
 import scipy
 import time
-from collections import deque
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cs530.utils.vtk_helper import storage_dtype
+from cs530.utils.vtk_profiling import NULL_PROFILER
 
 __all__ = [
     'Interpolator', 
-    'TimeInterpolator'
+    'TimeInterpolator',
+    'WindowScheduler',
+    'split_windows',
 ]
 
+# NRRD type names (and their aliases) and the corresponding numpy types
+_NRRD_TYPES = {}
+for _names, _code in [ (['signed char', 'int8', 'int8_t'], 'i1'),
+                       (['uchar', 'unsigned char', 'uint8', 'uint8_t'], 'u1'),
+                       (['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'], 'i2'),
+                       (['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'], 'u2'),
+                       (['int', 'signed int', 'int32', 'int32_t'], 'i4'),
+                       (['uint', 'unsigned int', 'uint32', 'uint32_t'], 'u4'),
+                       (['longlong', 'long long', 'long long int', 'signed long long', 'signed long long int',
+                         'int64', 'int64_t'], 'i8'),
+                       (['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'], 'u8'),
+                       (['float'], 'f4'),
+                       (['double'], 'f8') ]:
+    _NRRD_TYPES.update({ name: _code for name in _names })
+
 class _Utils:
     # flatten an array of arrays of numpy arrays
     @staticmethod
@@ -64,13 +86,131 @@ class _Utils:
                 reader = vtk.vtkXMLStructuredGridReader(file_name=filename)
                 reader.Update()
                 return reader.GetOutput()
-            case '.nrrd':
-                data, header = nrrd.read(filename)
-                # TODO: handle header
-                return None
+            case '.nrrd' | '.nhdr':
+                return _Utils._import_nrrd(filename)
             case _:
                 raise ValueError(f'Unrecognized or unsupported file type: {filename}')
 
+    @staticmethod
+    def _nrrd_dtype(header):
+        # numpy dtype of the samples described by a NRRD header
+        code = _NRRD_TYPES.get(str(header['type']).strip().lower())
+        if code is None:
+            raise ValueError(f'Unsupported NRRD type {header["type"]}')
+        if code[1] == '1':
+            return np.dtype(code)
+        endian = str(header.get('endian', 'little')).strip().lower()
+        if endian not in ['little', 'big']:
+            raise ValueError(f'Invalid NRRD endian {header["endian"]}')
+        return np.dtype(('<' if endian == 'little' else '>') + code)
+
+    @staticmethod
+    def _import_nrrd(filename):
+        # Only the header is read eagerly. Raw payloads (attached or detached)
+        # are memory-mapped and wrapped as vtkImageData point data without copy
+        # when their layout allows it; compressed payloads are decoded in memory
+        with open(filename, 'rb') as fh:
+            header = nrrd.read_header(fh)
+            sizes = [ int(n) for n in header['sizes'] ]
+            dtype = _Utils._nrrd_dtype(header)
+            data_file = header.get('data file', header.get('datafile', None))
+            line_skip = header.get('line skip', header.get('lineskip', 0))
+            byte_skip = header.get('byte skip', header.get('byteskip', 0))
+            mappable = header['encoding'] == 'raw' and \
+                (data_file is None or not data_file.startswith('LIST') and len(data_file.split()) == 1)
+            if not mappable:
+                data = nrrd.read_data(header, fh, filename, index_order='C')
+            else:
+                if data_file is not None:
+                    if not os.path.isabs(data_file):
+                        data_file = os.path.join(os.path.dirname(filename), data_file)
+                    fh = open(data_file, 'rb')
+                for _ in range(line_skip):
+                    fh.readline()
+                offset = fh.tell()
+                if data_file is not None:
+                    fh.close()
+                    payload = data_file
+                else:
+                    payload = filename
+                nbytes = dtype.itemsize*int(np.prod(sizes))
+                if byte_skip == -1:
+                    offset = os.path.getsize(payload) - nbytes
+                else:
+                    offset += byte_skip
+                # copy-on-write mapping: pages are only read when accessed
+                data = np.memmap(payload, dtype=dtype, mode='c', offset=offset, shape=tuple(reversed(sizes)))
+        if not data.dtype.isnative:
+            data = data.astype(data.dtype.newbyteorder('='))
+
+        # identify domain (spatial) axes and at most one component axis
+        ndim = len(sizes)
+        kinds = header.get('kinds', None)
+        directions = header.get('space directions', None)
+        if kinds is not None:
+            domain = [ k.lower() in ['domain', 'space', 'time'] for k in kinds ]
+        elif directions is not None:
+            domain = [ not np.any(np.isnan(d)) for d in directions ]
+        else:
+            domain = [ True ] * ndim
+        components = [ a for a in range(ndim) if not domain[a] ]
+        axes = [ a for a in range(ndim) if domain[a] ]
+        if len(components) > 1 or len(axes) > 3 or len(axes) == 0:
+            raise ValueError(f'Unsupported NRRD layout in {filename}: sizes={sizes}, kinds={kinds}')
+        if len(components) == 1 and components[0] != 0:
+            # component axis must vary fastest: move it (this requires a copy)
+            c = ndim-1-components[0]
+            data = np.ascontiguousarray(np.moveaxis(data, c, -1))
+        ncomp = sizes[components[0]] if components else 1
+        values = data.reshape(-1, ncomp) if ncomp > 1 else data.reshape(-1)
+
+        # tensor kinds are expanded to full 3x3 matrices
+        kind = kinds[components[0]].lower() if components and kinds is not None else ''
+        if kind.startswith('3d-masked'):
+            values = values[:, 1:]
+            ncomp -= 1
+        if ncomp == 6 and 'symmetric' in kind:
+            values = values[:, [0, 1, 2, 1, 3, 4, 2, 4, 5]]
+            ncomp = 9
+
+        # geometry
+        image = vtk.vtkImageData()
+        dims = [ sizes[a] for a in axes ] + [ 1 ] * (3-len(axes))
+        image.SetDimensions(dims)
+        origin = np.zeros(3)
+        spacing = np.ones(3)
+        frame = np.eye(3)
+        if 'space origin' in header:
+            o = np.array(header['space origin'], dtype=float)
+            origin[:len(o)] = o
+        if directions is not None:
+            for i, a in enumerate(axes):
+                d = np.zeros(3)
+                d[:len(directions[a])] = directions[a]
+                spacing[i] = np.linalg.norm(d)
+                if spacing[i] > 0:
+                    frame[:,i] = d/spacing[i]
+        elif 'spacings' in header:
+            sp = np.array(header['spacings'], dtype=float)
+            for i, a in enumerate(axes):
+                if not np.isnan(sp[a]): spacing[i] = sp[a]
+        image.SetOrigin(origin)
+        image.SetSpacing(spacing)
+        if not np.allclose(frame, np.eye(3)):
+            image.SetDirectionMatrix(frame.flatten())
+
+        array = numpy_to_vtk(values, deep=False)
+        array.SetName(header.get('content', 'values'))
+        if ncomp == 1:
+            image.GetPointData().SetScalars(array)
+        elif ncomp == 3:
+            image.GetPointData().SetVectors(array)
+        elif ncomp == 9:
+            image.GetPointData().SetTensors(array)
+        else:
+            image.GetPointData().AddArray(array)
+        return image
+
     @staticmethod
     def _get_attribute(dataset, name):
         if name.lower() == 'scalar' or name.lower() == 'scalars':
@@ -83,12 +223,15 @@ class _Utils:
             return dataset.GetPointData().GetArray(name)
 
     @staticmethod
-    def _locate(locator, p):
-        acell = vtk.vtkGenericCell()
-        subid = vtk.reference(0)
-        pcoords = np.zeros(3)
-        weights = np.zeros(8)
-        cellpts = vtk.vtkIdList()
+    def _scratch(size=8):
+        # reusable buffers for repeated calls to _locate
+        return vtk.vtkGenericCell(), vtk.reference(0), np.zeros(3), np.zeros(size), vtk.vtkIdList()
+
+    @staticmethod
+    def _locate(locator, p, scratch=None):
+        if scratch is None:
+            scratch = _Utils._scratch()
+        acell, subid, pcoords, weights, cellpts = scratch
         has_explicit_locator = isinstance(locator, vtk.vtkAbstractCellLocator)
         if has_explicit_locator:
             cellid = locator.FindCell(p, 0, acell, subid, pcoords, weights)
@@ -103,12 +246,367 @@ class _Utils:
                 locator.GetCellPoints(cellid, cellpts)
         return cellid, cellpts, weights
 
+    @staticmethod
+    def _shape_derivatives(cell, subid, pcoords):
+        # (npts,3) spatial derivatives of the interpolation functions of a
+        # cell, obtained by differentiating the identity at its vertices
+        npts = cell.GetNumberOfPoints()
+        derivs = np.zeros(3*npts)
+        cell.Derivatives(subid, pcoords, np.eye(npts).flatten(), npts, derivs)
+        return derivs.reshape(npts, 3)
+
+    @staticmethod
+    def _gather(field, ids, weights):
+        # weighted sum of field values at the vertices of each located cell
+        return np.einsum('nm,nm...->n...', weights, field[ids])
+
+    @staticmethod
+    def _pack(fields, dtype=None):
+        # single contiguous (npoints, total_components) array holding all fields
+        # and, for each field, its component slice and value shape. A single
+        # field is packed without copy unless it must be converted to dtype.
+        # Several fields are copied into a new array, even memory-mapped
+        # ones: TimeSeriesStore keeps them packed on disk instead
+        layout = []
+        columns = []
+        start = 0
+        for f in fields:
+            f = _Utils._as_numpy(f)
+            shape = f.shape[1:]
+            ncomp = int(np.prod(shape))
+            layout.append((start, start+ncomp, shape))
+            columns.append(f.reshape(f.shape[0], ncomp))
+            start += ncomp
+        if len(columns) == 1:
+            packed = columns[0] if dtype is None else columns[0].astype(dtype, copy=False)
+            return packed, layout
+        return np.concatenate(columns, axis=1, dtype=dtype), layout
+
+    @staticmethod
+    def _unpack(values, layout):
+        # split (..., total_components) values into per-field values
+        return [ values[..., start:stop].reshape(values.shape[:-1] + shape)[()] for start, stop, shape in layout ]
+
+    @staticmethod
+    def _unpack_jacobian(jacobian, layout):
+        # split (..., total_components, 3) derivatives into per-field (..., *shape, 3)
+        return [ jacobian[..., start:stop, :].reshape(jacobian.shape[:-2] + shape + (3,)) for start, stop, shape in layout ]
+
+    @staticmethod
+    def _split_jacobian(gathered, weights, dweights, layout):
+        # per-field values and jacobians from the packed values at cell vertices
+        values = _Utils._unpack(weights @ gathered, layout)
+        jacobians = _Utils._unpack_jacobian(gathered.T @ dweights, layout)
+        return _Utils._singleton_as_scalar(values), _Utils._singleton_as_scalar(jacobians)
+
     @staticmethod
     def _nbytes(fields):
-        return np.sum([field.nbytes for field in fields])
+        return np.sum([field.nbytes for field in _Utils._singleton_as_array(fields)])
+
+class _UniformGrid:
+    # Closed-form point location in axis-aligned vtkImageData: cell index and
+    # trilinear weights follow from origin and spacing. Vertex ids index the
+    # flattened (k, j, i) point data, i.e. id = i + nx*(j + ny*k).
+    tolerance = 1.0e-9
+
+    # voxel vertices in VTK point order
+    bits = np.array([[0,0,0], [1,0,0], [0,1,0], [1,1,0],
+                     [0,0,1], [1,0,1], [0,1,1], [1,1,1]], dtype=bool)
+
+    @staticmethod
+    def supports(image):
+        if not isinstance(image, vtk.vtkImageData):
+            return False
+        if hasattr(image, 'GetDirectionMatrix') and not image.GetDirectionMatrix().IsIdentity():
+            return False
+        return np.all(np.array(image.GetSpacing()) > 0)
+
+    def __init__(self, image):
+        self.origin = np.array(image.GetOrigin())
+        self.spacing = np.array(image.GetSpacing())
+        self.set_dimensions(image.GetDimensions())
+
+    def set_dimensions(self, dims):
+        self.dims = np.array(dims)
+        self.strides = np.array([1, self.dims[0], self.dims[0]*self.dims[1]], dtype=np.int64)
+        self.max_cell = np.maximum(self.dims-2, 0)
+        # flat offsets of voxel vertices. Along degenerate (single sample)
+        # axes the upper vertex is folded onto the lower one, with zero weight
+        self.offsets = (self.bits & (self.dims > 1)).astype(np.int64) @ self.strides
+
+    def cell_coordinates(self, points):
+        # (N,3) cell indices and local coordinates, unclamped, and cell sizes
+        x = (points-self.origin)/self.spacing
+        cell = np.minimum(np.floor(np.maximum(x, 0)), self.max_cell)
+        return cell, x-cell, self.spacing
+
+    def cells_and_weights(self, points, derivatives=False):
+        # (N,3) integer cell indices, (N,8) trilinear weights, out-of-bounds
+        # mask and, with derivatives, (N,8,3) spatial derivatives of the weights
+        cell, u, h = self.cell_coordinates(points)
+        # degenerate axes only admit their single coordinate
+        upper = np.where(self.dims > 1, 1, 0)+self.tolerance
+        oob = ~np.all((u >= -self.tolerance) & (u <= upper), axis=1)
+        u = np.clip(np.nan_to_num(u), 0, 1)
+        cell[oob] = 0
+        factors = np.where(self.bits, u[:,None,:], 1-u[:,None,:])
+        weights = np.prod(factors, axis=2)
+        weights[oob] = 0
+        if not derivatives:
+            return cell.astype(np.int64), weights, oob
+        slopes = np.where(self.bits, 1.0, -1.0) * (self.dims > 1) / np.reshape(h, (-1,1,3))
+        dweights = np.stack([ slopes[...,0]*factors[...,1]*factors[...,2],
+                              slopes[...,1]*factors[...,0]*factors[...,2],
+                              slopes[...,2]*factors[...,0]*factors[...,1] ], axis=-1)
+        dweights[oob] = 0
+        return cell.astype(np.int64), weights, oob, dweights
+
+    def locate_many(self, points, derivatives=False):
+        cell, *located = self.cells_and_weights(points, derivatives)
+        ids = (cell @ self.strides)[:,None] + self.offsets
+        return (ids,) + tuple(located)
+
+    def locate(self, p, derivatives=False):
+        located = self.locate_many(np.asarray(p, dtype=float).reshape(1, 3), derivatives)
+        if located[2][0]:
+            raise ValueError(f'Position {p} is not in dataset domain')
+        return tuple(x[0] for x in located[:2] + located[3:])
+
+class _RectilinearGrid(_UniformGrid):
+    # Point location in vtkRectilinearGrid by per-axis binary search in the
+    # cached coordinate arrays. Weights and vertex ids as in _UniformGrid.
+    @staticmethod
+    def supports(grid):
+        if not isinstance(grid, vtk.vtkRectilinearGrid):
+            return False
+        coords = [ _Utils._as_numpy(c) for c in [grid.GetXCoordinates(), grid.GetYCoordinates(), grid.GetZCoordinates()] ]
+        return all(np.all(np.diff(c) > 0) for c in coords)
+
+    def __init__(self, grid):
+        self.coords = [ np.array(_Utils._as_numpy(c), dtype=float) for c in
+                        [grid.GetXCoordinates(), grid.GetYCoordinates(), grid.GetZCoordinates()] ]
+        self.set_dimensions(grid.GetDimensions())
+
+    def cell_coordinates(self, points):
+        cell = np.zeros(points.shape)
+        u = np.zeros(points.shape)
+        h = np.ones(points.shape)
+        for axis, c in enumerate(self.coords):
+            x = points[:,axis]
+            if len(c) == 1:
+                # degenerate axis: only c[0] is inside
+                u[:,axis] = (x-c[0])/max(1, abs(c[0]))
+                continue
+            i = np.clip(np.searchsorted(c, x, side='right')-1, 0, len(c)-2)
+            cell[:,axis] = i
+            h[:,axis] = c[i+1]-c[i]
+            u[:,axis] = (x-c[i])/h[:,axis]
+        return cell, u, h
+
+class _TetWalker:
+    # Coherent point location in meshes of linear tetrahedra. Successive
+    # queries along a trajectory tend to fall in the same cell or next to it,
+    # so each position is first tested against its hinted cell, then walks
+    # across the face opposite its most negative barycentric coordinate, and
+    # the global cell locator is only used for positions left over. Tests
+    # are carried out for the whole batch at once from precomputed inverse
+    # edge matrices, face neighbours and vertex ids (about 160 bytes per cell).
+    faces = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+    max_steps = 8
+    tolerance = 1.0e-9
+
+    @staticmethod
+    def supports(dataset):
+        if not isinstance(dataset, vtk.vtkUnstructuredGrid) or dataset.GetNumberOfCells() == 0:
+            return False
+        return np.all(vtk_to_numpy(dataset.GetCellTypesArray()) == vtk.VTK_TETRA)
+
+    def __init__(self, dataset, locator):
+        self.locator = locator
+        cells = dataset.GetCells()
+        self.cells = vtk_to_numpy(cells.GetConnectivityArray()).astype(np.int64).reshape(-1, 4)
+        points = vtk_to_numpy(dataset.GetPoints().GetData()).astype(float)
+        self.origins = points[self.cells[:, 0]]
+        e1, e2, e3 = [ points[self.cells[:, i]] - self.origins for i in (1, 2, 3) ]
+        # rows of the inverse of the edge matrix [e1 e2 e3]: scaled cross products.
+        # Degenerate cells get NaN rows, are never hit and left to the locator
+        rows = np.stack([np.cross(e2, e3), np.cross(e3, e1), np.cross(e1, e2)], axis=1)
+        det = np.einsum('nj,nj->n', e1, rows[:, 0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.inverses = rows / np.where(det != 0, det, np.nan)[:, None, None]
+        # neighbours[c, i]: cell across the face of c opposite vertex i (-1 on the boundary)
+        a, b, c = [ self.cells[:, self.faces[:, k]].ravel() for k in range(3) ]
+        lo = np.minimum(np.minimum(a, b), c)
+        hi = np.maximum(np.maximum(a, b), c)
+        faces = np.stack([lo, a + b + c - lo - hi, hi], axis=1)
+        if len(points) < 1 << 21:
+            # one sortable key per face
+            order = np.argsort((lo << 42) | (faces[:, 1] << 21) | hi, kind='stable')
+        else:
+            order = np.lexsort(faces.T[::-1])
+        shared = np.flatnonzero(np.all(faces[order[1:]] == faces[order[:-1]], axis=1))
+        self.neighbors = np.full(len(faces), -1, dtype=np.int64)
+        self.neighbors[order[shared]] = order[shared+1] // 4
+        self.neighbors[order[shared+1]] = order[shared] // 4
+        self.neighbors = self.neighbors.reshape(-1, 4)
+        self.scratch = _Utils._scratch(4)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.neighbor_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return { 'hits': self.hits, 'neighbor_hits': self.neighbor_hits, 'misses': self.misses }
+
+    def barycentric(self, cells, points):
+        lam = np.einsum('nij,nj->ni', self.inverses[cells], points - self.origins[cells])
+        return np.concatenate([1 - lam.sum(axis=1, keepdims=True), lam], axis=1)
+
+    def derivatives(self, cells):
+        # (N,4,3) constant spatial derivatives of the barycentric coordinates
+        rows = self.inverses[cells]
+        return np.concatenate([-rows.sum(axis=1, keepdims=True), rows], axis=1)
+
+    def locate(self, p, hint=-1):
+        # single position version of locate_many
+        cell = hint
+        for step in range(self.max_steps + 1 if hint >= 0 else 0):
+            # python floats: cheaper than numpy calls on 4 values
+            l1, l2, l3 = (self.inverses[cell] @ (p - self.origins[cell])).tolist()
+            lam = (1 - l1 - l2 - l3, l1, l2, l3)
+            low = min(lam)
+            if low >= -self.tolerance:
+                if step == 0:
+                    self.hits += 1
+                else:
+                    self.neighbor_hits += 1
+                return cell, np.array(lam)
+            if low != low:
+                # degenerate cell
+                break
+            cell = int(self.neighbors[cell, lam.index(low)])
+            if cell < 0:
+                break
+        self.misses += 1
+        acell, subid, pcoords, scratch, _ = self.scratch
+        cell = self.locator.FindCell(p, 0, acell, subid, pcoords, scratch)
+        if cell < 0:
+            return -1, None
+        return cell, self.barycentric(np.array([cell]), p[None, :])[0]
+
+    def locate_many(self, points, hints=None):
+        # cell of each position (-1 outside of the mesh) and its barycentric
+        # coordinates. hints are updated in place
+        n = len(points)
+        found = np.full(n, -1, dtype=np.int64)
+        weights = np.zeros((n, 4))
+        if hints is not None:
+            current = hints.copy()
+            todo = np.flatnonzero(current >= 0)
+            for step in range(self.max_steps + 1):
+                if len(todo) == 0:
+                    break
+                lam = self.barycentric(current[todo], points[todo])
+                inside = lam.min(axis=1) >= -self.tolerance
+                hit = todo[inside]
+                found[hit] = current[hit]
+                weights[hit] = lam[inside]
+                if step == 0:
+                    self.hits += len(hit)
+                else:
+                    self.neighbor_hits += len(hit)
+                # walk across the face opposite the most negative coordinate
+                out = todo[~inside]
+                lam = lam[~inside]
+                lam[np.isnan(lam)] = 0
+                nxt = self.neighbors[current[out], np.argmin(lam, axis=1)]
+                current[out] = nxt
+                todo = out[nxt >= 0]
+        acell, subid, pcoords, scratch, _ = self.scratch
+        left = np.flatnonzero(found < 0)
+        self.misses += len(left)
+        for k in left:
+            found[k] = self.locator.FindCell(points[k], 0, acell, subid, pcoords, scratch)
+        located = left[found[left] >= 0]
+        if len(located):
+            weights[located] = self.barycentric(found[located], points[located])
+        if hints is not None:
+            hints[:] = found
+        return found, weights
+
+class _ArrayCache:
+    # Byte-budgeted LRU of arrays (decoded time steps, volume bricks) read
+    # on demand by reader(key). Keys requested through prefetch() are read
+    # by a background thread while the caller keeps working; get() waits
+    # for a pending read instead of issuing a new one.
+    def __init__(self, reader, max_bytes):
+        self.reader = reader
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.nbytes = 0
+        self.entry_nbytes = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'nbytes': int(self.nbytes), 'entries': len(self.entries) }
+
+    def capacity(self):
+        # number of entries that fit in the budget
+        if self.entry_nbytes == 0:
+            return 1
+        return max(int(self.max_bytes // self.entry_nbytes), 1)
+
+    def _insert(self, id, fields):
+        # called with lock held
+        if id in self.entries:
+            return
+        nbytes = _Utils._nbytes(fields)
+        self.entry_nbytes = max(self.entry_nbytes, nbytes)
+        self.entries[id] = fields
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= _Utils._nbytes(evicted)
+
+    def _load(self, id):
+        fields = self.reader(id)
+        with self.lock:
+            self._insert(id, fields)
+            self.pending.pop(id, None)
+        return fields
+
+    def get(self, id):
+        with self.lock:
+            if id in self.entries:
+                self.entries.move_to_end(id)
+                self.hits += 1
+                return self.entries[id]
+            future = self.pending.get(id)
+        if future is not None:
+            self.hits += 1
+            return future.result()
+        self.misses += 1
+        return self._load(id)
+
+    def prefetch(self, ids):
+        # schedule background reads of the given keys, in order,
+        # as far as the byte budget allows
+        with self.lock:
+            for id in ids[:self.capacity()]:
+                if id not in self.entries and id not in self.pending:
+                    self.pending[id] = self.executor.submit(self._load, id)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
 
 class InterpolatorBase:
-    def __init__(self, vtk_data, raise_oob_error=False):
+    def __init__(self, vtk_data, raise_oob_error=False, walk=False):
         self.data = vtk_data
         self.oob_error = raise_oob_error
         if isinstance(self.data, vtk.vtkPointSet):
@@ -121,119 +619,427 @@ class InterpolatorBase:
             self.locator = self.data
         else:
             raise ValueError('Unrecognized dataset type')
+        self.max_cell_size = max(self.data.GetMaxCellSize(), 8)
+        self.scratch = _Utils._scratch(self.max_cell_size)
+        # batched, hinted point location in tetrahedral meshes (see _TetWalker)
+        if walk and _TetWalker.supports(self.data):
+            self.walker = _TetWalker(self.data, self.locator)
+        else:
+            self.walker = None
+        self.hint = -1
+        # uniform and rectilinear grids bypass VTK's generic FindCell
+        if _UniformGrid.supports(self.data):
+            self.grid = _UniformGrid(self.data)
+        elif _RectilinearGrid.supports(self.data):
+            self.grid = _RectilinearGrid(self.data)
+        else:
+            self.grid = None
+
+    def reset_hint(self):
+        # forget the last located cell (e.g., when starting a new trajectory)
+        self.hint = -1
+
+    def cell_hints(self, n):
+        # per-position cell hints for locate_many and the batched evaluations
+        # of n particles (None where point location needs no hints)
+        return np.full(n, -1, dtype=np.int64) if self.walker is not None else None
+
+    def locator_stats(self):
+        # hit/miss counters of the cell cache (None for structured grids)
+        return self.walker.stats() if self.walker is not None else None
+
+    def _locate_generic(self, p, derivatives=False):
+        cellid, cellpts, weights = _Utils._locate(self.locator, p, self.scratch)
+        npts = cellpts.GetNumberOfIds()
+        located = (np.array([cellpts.GetId(i) for i in range(npts)], dtype=np.int64), weights[:npts].copy())
+        if derivatives:
+            acell, subid, pcoords, _, _ = self.scratch
+            self.data.GetCell(cellid, acell)
+            located += (_Utils._shape_derivatives(acell, subid.get(), pcoords),)
+        return located
+
+    def locate(self, p, derivatives=False):
+        # vertex ids and interpolation weights of the cell containing p.
+        # With derivatives, also the (npts,3) spatial derivatives of the weights
+        if self.grid is not None:
+            return self.grid.locate(p, derivatives)
+        if self.walker is not None:
+            self.hint, weights = self.walker.locate(np.asarray(p, dtype=float), self.hint)
+            if self.hint < 0:
+                raise ValueError(f'Position {p} is not in dataset domain')
+            located = (self.walker.cells[self.hint], weights)
+            if derivatives:
+                located += (self.walker.derivatives(np.array([self.hint]))[0],)
+            return located
+        return self._locate_generic(p, derivatives)
+
+    def locate_many(self, points, hints=None, derivatives=False):
+        # cell vertex ids and interpolation weights for a batch of positions.
+        # cells with fewer vertices than max_cell_size are padded with zero weights.
+        # hints: optional per-position array of last cell ids (-1 if unknown),
+        # updated in place, used by tetrahedral meshes with walk enabled.
+        # With derivatives, (N,max_cell_size,3) weight derivatives are returned last
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if self.grid is not None:
+            return self.grid.locate_many(points, derivatives)
+        n = points.shape[0]
+        ids = np.zeros((n, self.max_cell_size), dtype=np.int64)
+        weights = np.zeros((n, self.max_cell_size))
+        dweights = np.zeros((n, self.max_cell_size, 3)) if derivatives else None
+        if self.walker is not None:
+            cells, lam = self.walker.locate_many(points, hints)
+            oob = cells < 0
+            ids[~oob, :4] = self.walker.cells[cells[~oob]]
+            weights[:, :4] = lam
+            if derivatives:
+                dweights[~oob, :4] = self.walker.derivatives(cells[~oob])
+                return ids, weights, oob, dweights
+            return ids, weights, oob
+        oob = np.zeros(n, dtype=bool)
+        for k, p in enumerate(points):
+            try:
+                located = self._locate_generic(p, derivatives)
+            except ValueError:
+                oob[k] = True
+                continue
+            npts = len(located[0])
+            ids[k, :npts] = located[0]
+            weights[k, :npts] = located[1]
+            if derivatives:
+                dweights[k, :npts] = located[2]
+        if derivatives:
+            return ids, weights, oob, dweights
+        return ids, weights, oob
 
     def interpolate(self, p, fields):
         _fields = _Utils._singleton_as_array(fields)
         p = np.array(p)
         try:
-            _, cellpts, weights = _Utils._locate(self.locator, p)
+            ids, weights = self.locate(p)
         except ValueError as e:
             if self.oob_error:
                 raise e
             else:
                 return None
-        vals = [ np.zeros(f.shape[1]) for f in _fields ]
-        for i in range(cellpts.GetNumberOfIds()):
-            id = cellpts.GetId(i)
-            for j, f in enumerate(_fields):
-                vals[j] += weights[i] * f[id]
+        vals = [ np.atleast_1d(weights @ f[ids]) for f in _fields ]
         return _Utils._singleton_as_scalar([_Utils._singleton_as_scalar(v) for v in vals])
 
+    def _interpolate_packed(self, p, packed, layout):
+        # all fields of a packed array with a single location and gather
+        try:
+            ids, weights = self.locate(p)
+        except ValueError as e:
+            if self.oob_error:
+                raise e
+            else:
+                return None
+        return _Utils._singleton_as_scalar(_Utils._unpack(weights @ packed[ids], layout))
+
+    def _jacobian_packed(self, p, packed, layout):
+        # values and spatial derivatives of all fields of a packed array
+        # from a single location
+        try:
+            ids, weights, dweights = self.locate(p, derivatives=True)
+        except ValueError as e:
+            if self.oob_error:
+                raise e
+            else:
+                return None, None
+        return _Utils._split_jacobian(packed[ids], weights, dweights, layout)
+
+    def _interpolate_many(self, points, packed, layout, hints=None):
+        ids, weights, oob = self.locate_many(points, hints)
+        if self.oob_error and np.any(oob):
+            raise ValueError(f'{np.count_nonzero(oob)} positions are not in dataset domain')
+        values = _Utils._gather(packed, ids, weights)
+        values[oob] = np.nan
+        return _Utils._singleton_as_scalar(_Utils._unpack(values, layout)), oob
+
+    def _jacobian_many(self, points, packed, layout, hints=None):
+        ids, weights, oob, dweights = self.locate_many(points, hints, derivatives=True)
+        if self.oob_error and np.any(oob):
+            raise ValueError(f'{np.count_nonzero(oob)} positions are not in dataset domain')
+        gathered = packed[ids]
+        values = np.einsum('nm,nmc->nc', weights, gathered)
+        jacobians = np.einsum('nmd,nmc->ncd', dweights, gathered)
+        values[oob] = np.nan
+        jacobians[oob] = np.nan
+        return _Utils._singleton_as_scalar(_Utils._unpack(values, layout)), \
+               _Utils._singleton_as_scalar(_Utils._unpack_jacobian(jacobians, layout)), oob
+
 class Interpolator(InterpolatorBase):
-    def __init__(self, vtk_data, fields, raise_oob_error=False):
-        super().__init__(vtk_data, raise_oob_error)
+    def __init__(self, vtk_data, fields, raise_oob_error=False, dtype=None, walk=False):
+        # dtype: storage precision of the fields (e.g., np.float32), defaults
+        # to the global policy (see vtk_helper.set_precision) or to the
+        # fields' own type. Values are interpolated in float64.
+        # walk: hinted point location in tetrahedral meshes (see _TetWalker)
+        super().__init__(vtk_data, raise_oob_error, walk)
+        self.dtype = dtype
         self.set_fields(fields)
 
     def set_fields(self, fields):
-        self.fields = [ _Utils._as_numpy(f) for f in _Utils._singleton_as_array(fields) ]
-        self.nbytes = _Utils._nbytes(self.fields)
+        # fields are stored in one packed array; self.fields are views into it
+        fields = [ _Utils._as_numpy(f) for f in _Utils._singleton_as_array(fields) ]
+        self.packed, self.layout = _Utils._pack(fields, storage_dtype(self.dtype, default=None))
+        self.fields = [ self.packed[:, start:stop].reshape((-1,) + shape) for start, stop, shape in self.layout ]
+        self.nbytes = self.packed.nbytes
 
     def __call__(self, t, p):
-        return self.interpolate(p, self.fields)
+        return self._interpolate_packed(p, self.packed, self.layout)
+
+    def interpolate_many(self, points, hints=None):
+        # values at an (N,3) array of positions: (N,k) array per field
+        # (list if several fields) and (N,) out-of-bounds mask. 
+        # Out-of-bounds rows are set to NaN. hints: see locate_many
+        return self._interpolate_many(points, self.packed, self.layout, hints)
+
+    def value_and_jacobian(self, p):
+        # value and spatial derivatives (k,3) of each field at p, from one
+        # point location. (None, None) outside of the domain
+        return self._jacobian_packed(p, self.packed, self.layout)
+
+    def value_and_jacobian_many(self, points, hints=None):
+        # batched value_and_jacobian: (N,k) values, (N,k,3) jacobians per 
+        # field and (N,) out-of-bounds mask
+        return self._jacobian_many(points, self.packed, self.layout, hints)
+
+    def jacobian(self, t, p):
+        # signature expected by solve_ivp's jac argument
+        return self.value_and_jacobian(p)[1]
 
 class TimeInterpolator(InterpolatorBase):
 
-    def __init__(self, times, filenames, attributes=['vectors'], stack=3, raise_oob_error=False):
-        super().__init__(import_dataset(filenames[0]), raise_oob_error)
+    def __init__(self, times, filenames, attributes=['vectors'], stack=3, raise_oob_error=False,
+                 cache_bytes=None, prefetch=True, store=None, shared=None, dtype=None, walk=False):
+        # dtype: storage precision of cached time steps, walk: hinted point
+        # location (see Interpolator).
+        # cache_bytes: optional memory budget of the time steps. It then sets
+        # stack (see steps_in_budget) and bounds the steps read ahead.
+        # store: optional TimeSeriesStore (see vtk_timeseries) providing times,
+        # geometry and memory-mapped fields in place of times and filenames.
+        # shared: optional SharedFields whose published time steps are used
+        # instead of reading them again
+        self.store = store
+        self.shared = shared
+        self.dtype = dtype
+        if store is not None:
+            times = store.times
+            filenames = store.filenames
         ids = np.argsort(times)
         self.filenames = [filenames[i] for i in ids]
         self.times = [times[i] for i in ids]
+        self.step_ids = [int(i) for i in ids]
+        # geometry copied in the shared handle, stored once in the store,
+        # or that of the first time step
+        geometry = shared.geometry() if shared is not None else None
+        if geometry is None:
+            geometry = store.geometry() if store is not None else _Utils._import_dataset(self.filenames[0])
+        super().__init__(geometry, raise_oob_error, walk)
         self.field_names = attributes
-        self.stack = stack 
+        self._stack = max(stack, 2)
+        self._step_nbytes = None
+        # each cached time step is one packed array of all fields
         self.cached_fields = deque()
         self.cached_time_steps = deque()
         self.nfields = len(self.field_names)
+        self.layout = shared.layout if shared is not None else None
+        # optional byte-budgeted cache, filled ahead of integration in the
+        # direction of the last update when prefetch is enabled
+        self.cache = _ArrayCache(self.read_file, cache_bytes) if cache_bytes else None
+        self.prefetch = prefetch
+        # timings of reads, cell location and interpolation (see vtk_profiling)
+        self.profiler = NULL_PROFILER
+
+    @classmethod
+    def from_store(cls, store, attributes=None, **kwargs):
+        if isinstance(store, str):
+            from cs530.utils.vtk_timeseries import TimeSeriesStore
+            store = TimeSeriesStore(store)
+        if attributes is None:
+            attributes = store.attributes
+        return cls(None, None, attributes, store=store, **kwargs)
+
+    @classmethod
+    def from_shared(cls, handle, worker=None, **kwargs):
+        # worker-side interpolator attached to a SharedTimeSeries handle,
+        # reporting its progress as given worker (see SharedFields)
+        from cs530.utils.vtk_timeseries import TimeSeriesStore, SharedFields
+        store = TimeSeriesStore(handle['store']) if handle['store'] is not None else None
+        return cls(handle['times'], handle['filenames'], handle['attributes'], 
+                   store=store, shared=SharedFields(handle, worker), **kwargs)
+
+    def read_file(self, id):
+        # packed (npoints, total_components) array of all fields at time step id
+        if self.shared is not None:
+            packed = self.shared.read(id)
+            if packed is not None:
+                return packed
+        with self.profiler.phase('read'):
+            dtype = storage_dtype(self.dtype, default=None)
+            if self.store is not None:
+                # memory map of the stored packed array, copied only to
+                # convert its type
+                packed, self.layout = self.store.read_packed(self.step_ids[id], self.field_names)
+                if dtype is not None:
+                    packed = packed.astype(dtype, copy=False)
+            else:
+                dataset = _Utils._import_dataset(self.filenames[id])
+                fields = [ _Utils._as_numpy(_Utils._get_attribute(dataset, name)) for name in self.field_names ]
+                packed, self.layout = _Utils._pack(fields, dtype)
+        self.profiler.count('files_read')
+        self.profiler.count('bytes_read', int(packed.nbytes))
+        return packed
+
+    @property
+    def stack(self):
+        # number of time steps kept resident
+        if self.cache is None:
+            return self._stack
+        return self.steps_in_budget(self.cache.max_bytes)
+
+    @stack.setter
+    def stack(self, value):
+        # with a byte budget, the budget grows to keep value steps resident
+        self._stack = max(value, 2)
+        if self.cache is not None:
+            self.cache.max_bytes = max(self.cache.max_bytes, 2*self._stack*self.step_nbytes())
+
+    def step_nbytes(self):
+        # size of one packed time step, read once to find out
+        if self._step_nbytes is None:
+            self._step_nbytes = _Utils._nbytes(self.read(0))
+        return self._step_nbytes
+
+    def steps_in_budget(self, nbytes):
+        # resident time steps allowed by a budget of nbytes. It holds two
+        # windows of them: the one in use and the one read ahead (see
+        # update and WindowScheduler)
+        return max(int(nbytes // (2*self.step_nbytes())), 2)
+
+    @property
+    def nbytes(self):
+        # memory held by the cached time steps
+        arrays = list(self.cached_fields)
+        if self.cache is not None:
+            with self.cache.lock:
+                arrays += list(self.cache.entries.values())
+        return sum({ id(f): f.nbytes for f in arrays }.values())
+
+    def read(self, id):
+        if self.cache is not None:
+            return self.cache.get(int(id))
+        return self.read_file(id)
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.shared is not None:
+            # views of shared blocks must be gone before they are unmapped
+            self.cached_fields.clear()
+            self.cached_time_steps.clear()
+            self.shared.close()
 
     def load(self, ids, _case):
         if _case == 'full':
+            self.cached_fields.clear()
+            self.cached_time_steps.clear()
             for id in ids:
-                dataset = _Utils._import_dataset(self.filenames[id])
-                fields = [ _Utils._as_numpy(dataset.GetPointData().GetArray(name)) for name in self.field_names ]
-                self.cached_fields.append(fields)
+                self.cached_fields.append(self.read(id))
                 self.cached_time_steps.append(id)
         elif _case == 'left':
-            for id in ids:
-                self.cached_fields.pop()
-                self.cached_time_steps.pop()
-                dataset = _Utils._import_dataset(self.filenames[id])
-                fields = [ _Utils._as_numpy(dataset.GetPointData().GetArray(name)) for name in self.field_names ]
-                self.cached_fields.appendleft(fields)
+            for id in reversed(ids):
+                self.cached_fields.appendleft(self.read(id))
                 self.cached_time_steps.appendleft(id)
         elif _case == 'right':
             for id in ids:
-                self.cached_fields.popleft()
-                self.cached_time_steps.popleft()
-                dataset = _Utils._import_dataset(self.filenames[id])
-                fields = [ _Utils._as_numpy(dataset.GetPointData().GetArray(name)) for name in self.field_names ]
-                self.cached_fields.append(fields)
+                self.cached_fields.append(self.read(id))
                 self.cached_time_steps.append(id)
 
     def update(self, i, hint='centered'):
-        # find i such that t_{i-1} <= t < t_i
-        if i == 0 or i == len(self.times):
-            raise ValueError(f"Time {t} is out of bounds [{self.times[0]}, {self.times[-1]}]")
-        # currently cached time span
-        if len(self.cached_time_steps) > 0:
-            jmin = self.cached_time_steps[0]
-            jmax = self.cached_time_steps[-1] 
-        else:
-            jmin = 0
-            jmax = 0
+        # make sure that t_{i-1} and t_i are both cached
+        if i <= 0 or i >= len(self.times):
+            raise ValueError(f"Time step {i} is out of bounds [1, {len(self.times)-1}]")
         # compute desired bounds
         if hint == 'forward':
-            n0 = 1
-            n1 = self.stack-1
+            imin = i-1
         elif hint == 'backward':
-            n1 = 0
-            n0 = self.stack+1
+            imin = i+1-self.stack
         else: # balanced/centered
-            n0 = self.stack//2 
-            n1 = self.stack-n0
-        imin = max(i-n0, 0)
-        imax = min(i+n1, len(self.times)) 
-        if imin == 0: imax = min(self.stack-1, len(self.times)-1)
-        if imax == len(self.times)-1: imin = max(len(self.times)-self.stack, 0)
-        if jmax <= jmin or imin > jmax or imax < jmin:
+            imin = i-self.stack//2
+        imin = min(max(imin, 0), max(len(self.times)-self.stack, 0))
+        imax = min(imin+self.stack, len(self.times))-1
+        self.slide(imin, imax)
+        if self.cache is not None and self.prefetch:
+            # read ahead as far as the budget left by the stack allows
+            room = max(self.cache.capacity() - len(self.cached_time_steps), 0)
+            if hint == 'forward':
+                self.cache.prefetch(list(range(imax+1, len(self.times)))[:room])
+            elif hint == 'backward':
+                self.cache.prefetch(list(range(imin-1, -1, -1))[:room])
+
+    def slide(self, imin, imax):
+        # cache time steps imin to imax (included), reusing those already cached
+        if len(self.cached_time_steps) == 0 or imin > self.cached_time_steps[-1] or imax < self.cached_time_steps[0]:
             # no overlap: (re)load full stack
-            self.load(np.arange(imin, imax), 'full')
-        elif imin < jmin:
+            self.load(np.arange(imin, imax+1), 'full')
+            return
+        # drop time steps outside of desired bounds
+        while self.cached_time_steps[0] < imin:
+            self.cached_fields.popleft()
+            self.cached_time_steps.popleft()
+        while self.cached_time_steps[-1] > imax:
+            self.cached_fields.pop()
+            self.cached_time_steps.pop()
+        jmin = self.cached_time_steps[0]
+        jmax = self.cached_time_steps[-1]
+        if imin < jmin:
             # extend left
             self.load(np.arange(imin, jmin), 'left')
-        elif imax > jmax:
+        if imax > jmax:
             # extend right
             self.load(np.arange(jmax+1, imax+1), 'right')
-        # otherwise, nothing to do.
-
-    def fetch(self, t):
-        i = np.searchsorted(self.times, t)
-        if len(self.cached_times) == 0:
-            self.update(i, 'centered')
-        elif i < self.cached_times[0]:
-            self.update(i, 'left')
-        elif i > self.cached_times[-1]:
-            self.update(i, 'right')
-        j = np.searchsorted(self.cached_time_steps, i, side='right')
-        u = (t - self.cached_times[j-1]) / (self.cached_times[j] - self.cached_times[j-1])
+
+    def window_steps(self, t0, t1):
+        # first and last time steps needed to interpolate over [t0, t1]
+        lo, hi = min(t0, t1), max(t0, t1)
+        n = len(self.times)
+        imin = min(max(int(np.searchsorted(self.times, lo, side='right'))-1, 0), n-2)
+        imax = min(max(int(np.searchsorted(self.times, hi, side='left')), imin+1), n-1)
+        return imin, imax
+
+    def set_window(self, imin, fields):
+        # cache packed arrays of time steps imin, imin+1, ... read elsewhere
+        self.cached_fields = deque(fields)
+        self.cached_time_steps = deque(range(imin, imin+len(fields)))
+
+    def is_cached(self, i):
+        return len(self.cached_time_steps) > 0 and \
+            self.cached_time_steps[0] <= i-1 and i <= self.cached_time_steps[-1]
+
+    def step_index(self, t):
+        # i such that t_{i-1} <= t < t_i (t_{n-1} is included in last interval)
+        i = np.clip(np.searchsorted(self.times, t, side='right'), 1, len(self.times)-1)
+        if len(self.cached_time_steps):
+            # t at the end of the cached steps is taken from the last cached
+            # interval (u = 1) rather than loading the next time step
+            last = self.cached_time_steps[-1]
+            if last > 0:
+                i = np.where((i == last+1) & (np.asarray(t) == self.times[last]), last, i)
+        return i if np.ndim(i) else int(i)
+
+    def fetch(self, t, i=None):
+        if i is None:
+            i = self.step_index(t)
+        if not self.is_cached(i):
+            if len(self.cached_time_steps) == 0:
+                self.update(i, 'centered')
+            elif i-1 < self.cached_time_steps[0]:
+                self.update(i, 'backward')
+            else:
+                self.update(i, 'forward')
+        j = i - self.cached_time_steps[0]
+        # float64 weight: blending stays in double precision with float32 storage
+        u = np.float64((t - self.times[i-1]) / (self.times[i] - self.times[i-1]))
         return u, self.cached_fields[j-1], self.cached_fields[j]
 
     def __call__(self, t, p):
@@ -241,15 +1047,149 @@ class TimeInterpolator(InterpolatorBase):
             raise ValueError(f'Time {t} outside of temporal range {self.times[0]} - {self.times[-1]}')
 
         u, f0, f1 = self.fetch(t)
-        all_fields = [ f for f in fields for fields in [f0, f1]]
         try:
-            values = self.interpolate(p, all_fields)
-            if values is not None:
-                if self.nfields == 1: return (1-u)*values[0] + u*values[1]
-                else: return [ (1-u)*values[i] + u*values[i+self.nfields] for i in range(self.nfields) ]
-        except Exception as e:
-            print(f'Error interpolating at {p}: {e}')
-            raise e
+            ids, weights = self.locate(p)
+        except ValueError as e:
+            if self.oob_error:
+                print(f'Error interpolating at {p}: {e}')
+                raise e
+            else:
+                return None
+        # one gather for all fields and both time steps
+        values = weights @ ((1-u)*f0[ids] + u*f1[ids])
+        return _Utils._singleton_as_scalar(_Utils._unpack(values, self.layout))
+
+    def _evaluate_many(self, t, points, derivatives=False, hints=None):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        t = np.broadcast_to(np.asarray(t, dtype=float), points.shape[:1])
+        if np.any(t < self.times[0]) or np.any(t > self.times[-1]):
+            raise ValueError(f'Times outside of temporal range {self.times[0]} - {self.times[-1]}')
+        profiler = self.profiler
+        profiler.count('rhs_evaluations')
+        profiler.count('points_evaluated', len(points))
+        with profiler.phase('locate'):
+            ids, weights, oob, *dweights = self.locate_many(points, hints, derivatives=derivatives)
+        if self.oob_error and np.any(oob):
+            raise ValueError(f'{np.count_nonzero(oob)} positions are not in dataset domain')
+        with profiler.phase('interpolate'):
+            return self._blend_many(t, ids, weights, oob, dweights, derivatives)
+
+    def _blend_many(self, t, ids, weights, oob, dweights, derivatives):
+        steps = self.step_index(t)
+        values = None
+        jacobians = None
+        # one gather per time interval spanned by the batch
+        for i in np.unique(steps):
+            sel = steps == i
+            _, f0, f1 = self.fetch(t[sel][0], i)
+            u = ((t[sel] - self.times[i-1]) / (self.times[i] - self.times[i-1]))[:, None, None]
+            ids_i = ids[sel]
+            if values is None:
+                values = np.full((len(t), f0.shape[1]), np.nan)
+                if derivatives:
+                    jacobians = np.full((len(t), f0.shape[1], 3), np.nan)
+            gathered = (1-u)*f0[ids_i] + u*f1[ids_i]
+            values[sel] = np.einsum('nm,nmc->nc', weights[sel], gathered)
+            if derivatives:
+                jacobians[sel] = np.einsum('nmd,nmc->ncd', dweights[0][sel], gathered)
+        values[oob] = np.nan
+        values = _Utils._singleton_as_scalar(_Utils._unpack(values, self.layout))
+        if not derivatives:
+            return values, oob
+        jacobians[oob] = np.nan
+        return values, _Utils._singleton_as_scalar(_Utils._unpack_jacobian(jacobians, self.layout)), oob
+
+    def interpolate_many(self, t, points, hints=None):
+        # values at an (N,3) array of positions, at a single time t or at 
+        # per-position times (array of size N). Returns (N,k) array per field
+        # (list if several fields) and (N,) out-of-bounds mask.
+        # hints: per-position cell ids (see locate_many and cell_hints)
+        return self._evaluate_many(t, points, hints=hints)
+
+    def value_and_jacobian(self, t, p):
+        # value and spatial derivatives (k,3) of each field at (t, p), from
+        # one point location. (None, None) outside of the domain
+        if t < self.times[0] or t > self.times[-1]:
+            raise ValueError(f'Time {t} outside of temporal range {self.times[0]} - {self.times[-1]}')
+        u, f0, f1 = self.fetch(t)
+        try:
+            ids, weights, dweights = self.locate(p, derivatives=True)
+        except ValueError as e:
+            if self.oob_error:
+                raise e
+            else:
+                return None, None
+        return _Utils._split_jacobian((1-u)*f0[ids] + u*f1[ids], weights, dweights, self.layout)
+
+    def value_and_jacobian_many(self, t, points, hints=None):
+        # batched value_and_jacobian: (N,k) values, (N,k,3) jacobians per 
+        # field and (N,) out-of-bounds mask
+        return self._evaluate_many(t, points, derivatives=True, hints=hints)
+
+    def jacobian(self, t, p):
+        # signature expected by solve_ivp's jac argument
+        return self.value_and_jacobian(t, p)[1]
+
+def split_windows(boundaries, depth, start=0):
+    # (first, last) indices in boundaries of the successive time windows
+    # spanning depth boundaries each, from start on. Consecutive windows
+    # share their end boundary
+    windows = []
+    while start < len(boundaries)-1:
+        windows.append((start, min(start+depth-1, len(boundaries)-1)))
+        start = windows[-1][1]
+    return windows
+
+class WindowScheduler:
+    # double-buffered loading of the time windows of a TimeInterpolator.
+    # windows: (imin, imax) time step ranges in processing order. While
+    # window k is in use, the time steps of window k+1 that it lacks are read
+    # by a background thread. Only windows k and k+1 are resident and each
+    # time step is read once
+    def __init__(self, intp, windows):
+        self.intp = intp
+        self.windows = list(windows)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.resident = {}
+        self.pending = {}
+        self.reads = 0
+        self.wait_time = 0
+        self._schedule(0)
+
+    def _read(self, id):
+        self.reads += 1
+        return self.intp.read(id)
+
+    def _schedule(self, k):
+        if k >= len(self.windows):
+            return
+        imin, imax = self.windows[k]
+        for id in range(imin, imax+1):
+            if id not in self.resident and id not in self.pending:
+                self.pending[id] = self.executor.submit(self._read, id)
+
+    def activate(self, k):
+        # install window k in the interpolator and start reading window k+1
+        imin, imax = self.windows[k]
+        start = time.perf_counter()
+        for id in range(imin, imax+1):
+            if id not in self.resident:
+                self.resident[id] = self.pending.pop(id).result()
+        self.wait_time += time.perf_counter() - start
+        self.intp.profiler.add_time('read_wait', time.perf_counter() - start)
+        keep = set(range(imin, imax+1))
+        if k+1 < len(self.windows):
+            keep |= set(range(self.windows[k+1][0], self.windows[k+1][1]+1))
+        for id in list(self.resident):
+            if id not in keep:
+                del self.resident[id]
+        self.intp.set_window(imin, [ self.resident[id] for id in range(imin, imax+1) ])
+        self._schedule(k+1)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.resident.clear()
+        self.pending.clear()
 
 def main():
     parser = argparse.ArgumentParser(description='Test RHS wrapper for VTK datasets')
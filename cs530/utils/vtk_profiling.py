@@ -0,0 +1,131 @@
+import time
+import json
+import threading
+from contextlib import nullcontext
+
+'''
+Lightweight instrumentation of long computations: wall time per named phase
+and named counters, gathered in a Profiler that can be merged across worker
+processes, exported as JSON and printed as a table. Code is instrumented
+against NULL_PROFILER by default, whose methods do nothing.
+'''
+
+__all__ = [
+    'Profiler',
+    'NULL_PROFILER',
+]
+
+class _Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class Profiler:
+    ''' Accumulates phase timings (seconds and number of calls) and counters.
+        Phases may be nested (e.g., 'locate' within 'integrate'), in which
+        case their times overlap, and merged worker timings add up, so that
+        phase totals can exceed the wall time '''
+    enabled = True
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+    def phase(self, name):
+        # context manager timing a phase
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stop(self):
+        # freeze the total wall time
+        self.elapsed = time.perf_counter() - self.start
+        return self
+
+    def merge(self, stats):
+        # add the timings and counters of another Profiler or of its to_dict()
+        if isinstance(stats, Profiler):
+            stats = stats.to_dict()
+        for name, phase in stats['phases'].items():
+            self.add_time(name, phase['seconds'], phase['calls'])
+        for name, n in stats['counters'].items():
+            self.count(name, n)
+
+    def to_dict(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.start
+        with self.lock:
+            return { 'elapsed': elapsed,
+                     'phases': { name: { 'seconds': self.times[name], 'calls': self.calls[name] } for name in self.times },
+                     'counters': dict(self.counters) }
+
+    def to_json(self, filename=None):
+        text = json.dumps(self.to_dict(), indent=1)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(text)
+        return text
+
+    def table(self):
+        stats = self.to_dict()
+        elapsed = stats['elapsed']
+        lines = [ f'{"phase":<24}{"seconds":>12}{"calls":>10}{"%":>8}' ]
+        for name, phase in sorted(stats['phases'].items(), key=lambda x: -x[1]['seconds']):
+            share = 100*phase['seconds']/elapsed if elapsed > 0 else 0
+            lines.append(f'{name:<24}{phase["seconds"]:>12.4f}{phase["calls"]:>10}{share:>8.1f}')
+        lines.append(f'{"total (wall)":<24}{elapsed:>12.4f}')
+        if stats['counters']:
+            lines.append('')
+            lines.append(f'{"counter":<24}{"value":>12}')
+            for name, n in sorted(stats['counters'].items()):
+                lines.append(f'{name:<24}{n:>12}')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.table()
+
+_NULL_CONTEXT = nullcontext()
+
+class _NullProfiler(Profiler):
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def phase(self, name):
+        return _NULL_CONTEXT
+
+    def add_time(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def stop(self):
+        return self
+
+    def merge(self, stats):
+        pass
+
+    def to_dict(self):
+        return { 'elapsed': 0.0, 'phases': {}, 'counters': {} }
+
+NULL_PROFILER = _NullProfiler()
@@ -0,0 +1,396 @@
+import os
+import json
+import argparse
+import uuid
+import time
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+from multiprocessing import shared_memory
+
+from cs530.utils.vtk_interpolation import _Utils
+
+'''
+Memory-mappable storage of time-varying fields: the geometry of the first
+time step is stored once and the fields of every time step are saved,
+packed in one (npoints, total_components) array as TimeInterpolator caches
+them, in an uncompressed .npy file that can be mapped without copy or XML
+parsing.
+'''
+
+__all__ = [
+    'pack_time_series',
+    'TimeSeriesStore',
+    'SharedTimeSeries',
+    'SharedFields',
+]
+
+_MANIFEST = 'manifest.json'
+
+def _field_filename(step, name):
+    return f'{step:05d}_{name}.npy'
+
+def _packed_filename(step):
+    return f'{step:05d}_packed.npy'
+
+def _write_geometry(dataset, path):
+    if isinstance(dataset, vtk.vtkImageData):
+        return _describe_geometry(dataset)
+    geometry = dataset.NewInstance()
+    geometry.CopyStructure(dataset)
+    if isinstance(dataset, vtk.vtkUnstructuredGrid):
+        filename = 'geometry.vtu'
+    elif isinstance(dataset, vtk.vtkRectilinearGrid):
+        filename = 'geometry.vtr'
+    elif isinstance(dataset, vtk.vtkStructuredGrid):
+        filename = 'geometry.vts'
+    else:
+        raise ValueError(f'Unsupported dataset type {dataset.GetClassName()}')
+    writer = vtk.vtkXMLDataSetWriter()
+    writer.SetFileName(os.path.join(path, filename))
+    writer.SetInputData(geometry)
+    writer.SetCompressorTypeToNone()
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.Write()
+    return { 'type': 'file', 'filename': filename }
+
+def _describe_geometry(dataset):
+    # picklable copy of the geometry of a dataset, rebuilt by _build_geometry
+    # without reading or parsing any file
+    if isinstance(dataset, vtk.vtkImageData):
+        matrix = dataset.GetDirectionMatrix()
+        return { 'type': 'image',
+                 'dimensions': list(dataset.GetDimensions()),
+                 'origin': list(dataset.GetOrigin()),
+                 'spacing': list(dataset.GetSpacing()),
+                 'direction': [ matrix.GetElement(i, j) for i in range(3) for j in range(3) ] }
+    if isinstance(dataset, vtk.vtkRectilinearGrid):
+        return { 'type': 'rectilinear',
+                 'dimensions': list(dataset.GetDimensions()),
+                 'coordinates': [ numpy_support.vtk_to_numpy(c).copy() for c in 
+                                  (dataset.GetXCoordinates(), dataset.GetYCoordinates(), dataset.GetZCoordinates()) ] }
+    points = numpy_support.vtk_to_numpy(dataset.GetPoints().GetData()).copy()
+    if isinstance(dataset, vtk.vtkStructuredGrid):
+        return { 'type': 'structured', 'extent': list(dataset.GetExtent()), 'points': points }
+    if isinstance(dataset, vtk.vtkUnstructuredGrid) and dataset.GetPolyhedronFaces() is None:
+        cells = dataset.GetCells()
+        return { 'type': 'unstructured', 'points': points,
+                 'offsets': numpy_support.vtk_to_numpy(cells.GetOffsetsArray()).astype(np.int64),
+                 'connectivity': numpy_support.vtk_to_numpy(cells.GetConnectivityArray()).astype(np.int64),
+                 'types': numpy_support.vtk_to_numpy(dataset.GetCellTypesArray()).copy() }
+    raise ValueError(f'Unsupported dataset type {dataset.GetClassName()}')
+
+def _build_geometry(info):
+    if info['type'] == 'image':
+        image = vtk.vtkImageData()
+        image.SetDimensions(info['dimensions'])
+        image.SetOrigin(info['origin'])
+        image.SetSpacing(info['spacing'])
+        # manifests written before the direction was stored are axis-aligned
+        if 'direction' in info:
+            image.SetDirectionMatrix(info['direction'])
+        return image
+    if info['type'] == 'rectilinear':
+        grid = vtk.vtkRectilinearGrid()
+        grid.SetDimensions(info['dimensions'])
+        x, y, z = [ numpy_support.numpy_to_vtk(c, deep=1) for c in info['coordinates'] ]
+        grid.SetXCoordinates(x)
+        grid.SetYCoordinates(y)
+        grid.SetZCoordinates(z)
+        return grid
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(info['points'], deep=1))
+    if info['type'] == 'structured':
+        grid = vtk.vtkStructuredGrid()
+        grid.SetExtent(info['extent'])
+        grid.SetPoints(points)
+        return grid
+    grid = vtk.vtkUnstructuredGrid()
+    grid.SetPoints(points)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_support.numpy_to_vtk(info['offsets'], deep=1, array_type=vtk.VTK_ID_TYPE),
+                  numpy_support.numpy_to_vtk(info['connectivity'], deep=1, array_type=vtk.VTK_ID_TYPE))
+    grid.SetCells(numpy_support.numpy_to_vtk(info['types'], deep=1, array_type=vtk.VTK_UNSIGNED_CHAR), cells)
+    return grid
+
+''' Convert a time series of VTK datasets into a TimeSeriesStore in
+    directory path '''
+def pack_time_series(times, filenames, path, attributes=['vectors'], verbose=False):
+    if len(times) != len(filenames):
+        raise ValueError('Filenames and times do not match')
+    os.makedirs(path, exist_ok=True)
+    ids = np.argsort(times)
+    manifest = { 'times': [ float(times[i]) for i in ids ],
+                 'attributes': list(attributes),
+                 'sources': [ os.path.basename(filenames[i]) for i in ids ] }
+    for step, i in enumerate(ids):
+        dataset = _Utils._import_dataset(filenames[i])
+        if step == 0:
+            manifest['geometry'] = _write_geometry(dataset, path)
+            manifest['npoints'] = dataset.GetNumberOfPoints()
+        elif dataset.GetNumberOfPoints() != manifest['npoints']:
+            raise ValueError(f'Geometry of {filenames[i]} differs from first time step')
+        fields = []
+        for name in attributes:
+            array = _Utils._get_attribute(dataset, name)
+            if array is None:
+                raise ValueError(f'No attribute {name} in {filenames[i]}')
+            fields.append(_Utils._as_numpy(array))
+        # packed once here rather than each time the step is read
+        packed, layout = _Utils._pack(fields)
+        manifest['layout'] = [ [start, stop, list(shape)] for start, stop, shape in layout ]
+        np.save(os.path.join(path, _packed_filename(step)), packed)
+        if verbose: print(f'packed {filenames[i]}')
+    with open(os.path.join(path, _MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return TimeSeriesStore(path)
+
+class TimeSeriesStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _MANIFEST)) as f:
+            manifest = json.load(f)
+        self.times = manifest['times']
+        self.attributes = manifest['attributes']
+        self.filenames = manifest['sources']
+        self.npoints = manifest['npoints']
+        self.geometry_info = manifest['geometry']
+        # stores written before fields were packed have one file per field
+        self.layout = None
+        if 'layout' in manifest:
+            self.layout = [ (start, stop, tuple(shape)) for start, stop, shape in manifest['layout'] ]
+
+    def __len__(self):
+        return len(self.times)
+
+    def geometry(self):
+        info = self.geometry_info
+        if info['type'] == 'image':
+            return _build_geometry(info)
+        return _Utils._import_dataset(os.path.join(self.path, info['filename']))
+
+    def read(self, step, names=None):
+        # read-only memory maps of the requested fields at given time step
+        if names is None:
+            names = self.attributes
+        for name in names:
+            if name not in self.attributes:
+                raise ValueError(f'No attribute {name} in time series {self.path}')
+        if self.layout is None:
+            return [ np.load(os.path.join(self.path, _field_filename(int(step), name)), mmap_mode='r') for name in names ]
+        packed = np.load(os.path.join(self.path, _packed_filename(int(step))), mmap_mode='r')
+        fields = []
+        for name in names:
+            start, stop, shape = self.layout[self.attributes.index(name)]
+            fields.append(packed[:, start:stop].reshape((-1,) + shape))
+        return fields
+
+    def read_packed(self, step, names=None):
+        # packed array of the requested fields and its layout (see
+        # _Utils._pack). A memory map of the stored array when all
+        # attributes are requested in stored order, else a packed copy
+        if names is None:
+            names = self.attributes
+        if self.layout is not None and list(names) == self.attributes:
+            return np.load(os.path.join(self.path, _packed_filename(int(step))), mmap_mode='r'), self.layout
+        return _Utils._pack(self.read(step, names))
+
+def _attach(name):
+    # attach to an existing block without handing its lifetime to this
+    # process' resource tracker (the owner unlinks it)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13: workers started through multiprocessing share the
+        # owner's resource tracker, which already knows about the block
+        return shared_memory.SharedMemory(name=name)
+
+# state of a time step in the control block of a SharedTimeSeries
+_UNSHARED = 0   # read from disk by the workers
+_SCHEDULED = 1  # about to be published: workers wait for it
+_PUBLISHED = 2
+
+class SharedTimeSeries:
+    ''' Owner side of a shared-memory field cache. Time steps of a
+        TimeInterpolator are loaded once, by this process, into named
+        shared-memory blocks. Worker processes receive handle() and build
+        their own TimeInterpolator with TimeInterpolator.from_shared(handle),
+        which takes the geometry from the handle and maps read-only views
+        of the published blocks instead of loading files.
+        Only the time window being integrated should be resident: publish()
+        the steps of the current window and of the one prefetched next,
+        and release() the steps that no later window needs once the
+        workers are done with a window. Workers report the window they are
+        in (see SharedFields.report and progress()). Steps that are
+        schedule()d are waited for by the workers, other steps that are
+        not published are read from disk. '''
+    def __init__(self, intp, prefix=None, workers=0):
+        self.intp = intp
+        self.prefix = prefix if prefix is not None else f'cs530_{uuid.uuid4().hex[:12]}'
+        self.blocks = {}
+        self.shape = None
+        self.dtype = None
+        # control block: state of each time step, then the progress 
+        # reported by each worker (-1 until its first report)
+        self.nsteps = len(intp.times)
+        self.control_block = shared_memory.SharedMemory(name=f'{self.prefix}_control', create=True, 
+                                                        size=8*(self.nsteps + workers))
+        self.control = np.ndarray(self.nsteps + workers, dtype=np.int64, buffer=self.control_block.buf)
+        self.control[:self.nsteps] = _UNSHARED
+        self.control[self.nsteps:] = -1
+
+    def schedule(self, steps):
+        # announce time steps that will be published, so that workers
+        # needing them wait instead of reading them from disk
+        for step in steps:
+            if self.control[int(step)] == _UNSHARED:
+                self.control[int(step)] = _SCHEDULED
+
+    def publish(self, steps):
+        # load given time steps into shared memory
+        for step in steps:
+            step = int(step)
+            if step in self.blocks:
+                continue
+            # one block per time step holding the packed fields
+            packed = np.ascontiguousarray(self.intp.read_file(step))
+            if self.shape is None:
+                self.shape, self.dtype = packed.shape, packed.dtype.str
+            shm = shared_memory.SharedMemory(name=f'{self.prefix}_{step}', create=True, size=max(packed.nbytes, 1))
+            np.ndarray(packed.shape, dtype=packed.dtype, buffer=shm.buf)[...] = packed
+            self.blocks[step] = shm
+            self.control[step] = _PUBLISHED
+
+    def release(self, steps):
+        # free time steps that are no longer needed by any worker
+        for step in steps:
+            step = int(step)
+            self.control[step] = _UNSHARED
+            if step in self.blocks:
+                shm = self.blocks.pop(step)
+                shm.close()
+                shm.unlink()
+
+    def published(self):
+        return set(self.blocks.keys())
+
+    def progress(self):
+        # last value reported by each worker
+        return self.control[self.nsteps:].copy()
+
+    def nbytes(self):
+        return sum(shm.size for shm in self.blocks.values())
+
+    def handle(self):
+        # picklable description of the geometry and of the shared blocks
+        # (geometry None if it cannot be copied, in which case workers
+        # import it from the first time step)
+        if self.shape is None:
+            raise ValueError('Time steps must be published before the handle is shared')
+        try:
+            geometry = _describe_geometry(self.intp.data)
+        except ValueError:
+            geometry = None
+        return { 'times': list(self.intp.times),
+                 'filenames': list(self.intp.filenames),
+                 'attributes': list(self.intp.field_names),
+                 'store': self.intp.store.path if self.intp.store is not None else None,
+                 'geometry': geometry,
+                 'fields': self.intp.layout,
+                 'prefix': self.prefix,
+                 'nsteps': self.nsteps,
+                 'workers': len(self.control) - self.nsteps,
+                 'shape': self.shape,
+                 'dtype': self.dtype }
+
+    def close(self):
+        self.release(list(self.blocks.keys()))
+        if self.control_block is not None:
+            del self.control
+            self.control_block.close()
+            self.control_block.unlink()
+            self.control_block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SharedFields:
+    ''' Worker side of SharedTimeSeries: read-only views of the published
+        time steps. A scheduled time step is waited for, up to timeout
+        seconds, before the worker reads it from disk itself '''
+    def __init__(self, handle, worker=None, timeout=60.0):
+        self.layout = handle['fields']
+        self.info = handle['geometry']
+        self.prefix = handle['prefix']
+        self.nsteps = handle['nsteps']
+        self.shape = tuple(handle['shape'])
+        self.dtype = np.dtype(handle['dtype'])
+        self.worker = worker
+        self.timeout = timeout
+        self.control_block = _attach(f'{self.prefix}_control')
+        self.control = np.ndarray(self.nsteps + handle['workers'], dtype=np.int64, buffer=self.control_block.buf)
+        self.blocks = {}
+
+    def geometry(self):
+        # dataset built from the handle, None if the handle has no geometry
+        return _build_geometry(self.info) if self.info is not None else None
+
+    def report(self, position):
+        # progress of this worker for the owner (None when done)
+        if self.worker is not None:
+            self.control[self.nsteps + self.worker] = np.iinfo(np.int64).max if position is None else position
+
+    def read(self, step):
+        # packed fields at given time step, None if it is not published
+        step = int(step)
+        deadline = time.monotonic() + self.timeout
+        while self.control[step] == _SCHEDULED and time.monotonic() < deadline:
+            time.sleep(0.001)
+        if self.control[step] != _PUBLISHED:
+            return None
+        if step not in self.blocks:
+            try:
+                self.blocks[step] = _attach(f'{self.prefix}_{step}')
+            except FileNotFoundError:
+                # released in the meantime
+                return None
+            self._detach()
+        view = np.ndarray(self.shape, dtype=self.dtype, buffer=self.blocks[step].buf)
+        view.setflags(write=False)
+        return view
+
+    def _detach(self):
+        # unmap blocks released by the owner that are no longer viewed
+        for step in [ s for s in self.blocks if self.control[s] != _PUBLISHED ]:
+            try:
+                self.blocks[step].close()
+            except BufferError:
+                continue
+            del self.blocks[step]
+
+    def close(self):
+        for shm in self.blocks.values():
+            shm.close()
+        self.blocks = {}
+        if self.control_block is not None:
+            del self.control
+            self.control_block.close()
+            self.control_block = None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a time series of VTK datasets for memory-mapped access')
+    parser.add_argument('-f', '--filenames', type=str, nargs='+', required=True, help='Files containing the time steps')
+    parser.add_argument('-t', '--times', type=float, nargs='+', help='Time coordinates of individual time steps')
+    parser.add_argument('--delta_t', type=float, default=1, help='Time interval between timesteps (if uniform)')
+    parser.add_argument('--t_init', type=float, default=0, help='Time coordinate of first time step')
+    parser.add_argument('-a', '--attributes', type=str, nargs='+', default=['vectors'], help='Names of fields to store')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Output directory')
+    args = parser.parse_args()
+
+    if args.times is None:
+        args.times = [ args.t_init + n*args.delta_t for n, _ in enumerate(args.filenames) ]
+    pack_time_series(args.times, args.filenames, args.output, args.attributes, verbose=True)
@@ -5,10 +5,11 @@ import argparse
 import cs530.utils.vtk_dataset as vdat
 import cs530.utils.vtk_rendering as vren
 import cs530.utils.vtk_colors as vcol
+import cs530.tools.kernels as kern
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Test cs530.utils modules')
-    parser.add_argument('id', type=int, help='Test case id:\n 1. Test vtk_dataset\n 2. Test vtk_rendering\n 3. Test vtk_colors')
+    parser.add_argument('id', type=int, help='Test case id:\n 1. Test vtk_dataset\n 2. Test vtk_rendering\n 3. Test vtk_colors\n 4. Test agreement of kernels backends')
     args = parser.parse_args()
 
     if args.id == 1:
@@ -17,4 +18,6 @@ if __name__ == '__main__':
         vren.main()
     elif args.id == 3:
         vcol.main()
+    elif args.id == 4:
+        kern.main()
 